@@ -20,6 +20,7 @@
 #     http://asdl.sourceforge.net/
 # -------------------------------------------------------------------------------
 from collections import namedtuple
+import hashlib
 import re
 import typing
 
@@ -235,11 +236,21 @@ def check(mod):
 # here is the top-level parse function.
 
 
+_parsed = {}
+
+
 def parse(filename):
-    """Parse ASDL from the given file and return a Module node describing it."""
-    with open(filename, encoding="utf-8") as f:
-        parser = ASDLParser()
-        return parser.parse(f.read())
+    """Parse ASDL from the given file and return a Module node describing it.
+
+    Results are cached by the file's content, so don't modify them.
+    """
+    with open(filename, "rb") as f:
+        raw = f.read()
+    key = hashlib.sha256(raw).digest()
+    mod = _parsed.get(key)
+    if mod is None:
+        mod = _parsed[key] = ASDLParser().parse(raw.decode("utf-8"))
+    return mod
 
 
 # Types for describing tokens in an ASDL specification.
@@ -285,44 +296,82 @@ class ASDLSyntaxError(Exception):
         return "Syntax error on line {0.lineno}: {0.msg}".format(self)
 
 
+# The whole buffer is scanned in one go, each match eating the whitespace in
+# front of a token, comments turning into empty strings. Line numbers are
+# only worked out when needed, by counting line breaks (the same ones
+# str.splitlines knows) up to the token.
+_breaks = "\n\r\v\f\x1c\x1d\x1e\x85\u2028\u2029"
+_scanner = re.compile(r"\s*(?:--[^{0}]*|(\w+|\S))".format(_breaks))
+_lines = re.compile(r"[^\S{0}]*(?:(\r\n|[{0}])|--[^{0}]*|(\w+|\S))".format(_breaks))
+_Invalid = -1
+_kinds = {None: None}  # kinds of the token values seen so far
+
+
+def _kind(c):
+    if c[0].isalpha():
+        return TokenKind.ConstructorId if c[0].isupper() else TokenKind.TypeId
+    return TokenKind.operator_table.get(c, _Invalid)
+
+
+def _tokens(buf):
+    """Yield (kind, value, lineno) of every token in buf, invalid operators
+    having the kind _Invalid."""
+    lineno = 1
+    for nl, c in _lines.findall(buf):
+        if nl:
+            lineno += 1
+        elif c:
+            kind = _kinds.get(c)
+            if kind is None:
+                kind = _kinds[c] = _kind(c)
+            yield kind, c, lineno
+
+
 def tokenize_asdl(buf):
     """Tokenize the given buffer. Yield Token objects."""
-    for lineno, line in enumerate(buf.splitlines(), 1):
-        for m in re.finditer(r"\s*(\w+|--.*|.)", line.strip()):
-            c = m.group(1)
-            if c[0].isalpha():
-                # Some kind of identifier
-                if c[0].isupper():
-                    yield Token(TokenKind.ConstructorId, c, lineno)
-                else:
-                    yield Token(TokenKind.TypeId, c, lineno)
-            elif c[:2] == "--":
-                # Comment
-                break
-            else:
-                # Operators
-                try:
-                    op_kind = TokenKind.operator_table[c]
-                except KeyError:
-                    raise ASDLSyntaxError("Invalid operator %s" % c, lineno)
-                yield Token(op_kind, c, lineno)
+    for kind, value, lineno in _tokens(buf):
+        if kind == _Invalid:
+            raise ASDLSyntaxError("Invalid operator %s" % value, lineno)
+        yield Token(kind, value, lineno)
 
 
 class ASDLParser:
     """Parser for ASDL files.
 
     Create, then call the parse method on a buffer containing ASDL.
-    This is a simple recursive descent parser that uses tokenize_asdl for the
-    lexing.
+    This is a simple recursive descent parser. It scans the buffer up front
+    into token values and looks their kinds up as it goes; line numbers
+    (and Tokens for cur_token) are only made when asked for.
     """
 
     def __init__(self):
-        self._tokenizer = None
-        self.cur_token = None
+        self._buf = ""
+        self._values = [None]
+        self._pos = self._end = 0
+        self._kind = self._value = None
+
+    @property
+    def cur_token(self):
+        """The current Token, None at the end of the input."""
+        if self._kind is None:
+            return None
+        return Token(self._kind, self._value, self._lineno)
+
+    @property
+    def _lineno(self):
+        # the line of the current token (or the last one, at the end)
+        pos = min(self._pos, len(self._values) - 2)
+        for i, (_, _, lineno) in enumerate(_tokens(self._buf)):
+            if i == pos:
+                return lineno
+        return 1
 
     def parse(self, buf):
         """Parse the ASDL in the buffer and return an AST with a Module root."""
-        self._tokenizer = tokenize_asdl(buf)
+        self._buf = buf
+        # None marks the end of the input
+        self._values = [i for i in _scanner.findall(buf) if i] + [None]
+        self._pos, self._end = -1, len(self._values) - 1
         self._advance()
         return self._parse_module()
 
@@ -331,8 +380,8 @@ class ASDLParser:
             self._advance()
         else:
             raise ASDLSyntaxError(
-                'Expected "module" (found {})'.format(self.cur_token.value),
-                self.cur_token.lineno,
+                'Expected "module" (found {})'.format(self._value),
+                self._lineno,
             )
         name = self._match(self._id_kinds)
         self._match(TokenKind.LBrace)
@@ -342,7 +391,7 @@ class ASDLParser:
 
     def _parse_definitions(self):
         defs = []
-        while self.cur_token.kind == TokenKind.TypeId:
+        while self._kind == TokenKind.TypeId:
             typename = self._advance()
             self._match(TokenKind.Equals)
             type = self._parse_type()
@@ -350,7 +399,7 @@ class ASDLParser:
         return defs
 
     def _parse_type(self):
-        if self.cur_token.kind == TokenKind.LParen:
+        if self._kind == TokenKind.LParen:
             # If we see a (, it's a product
             return self._parse_product()
         else:
@@ -360,7 +409,7 @@ class ASDLParser:
                     self._match(TokenKind.ConstructorId), self._parse_optional_fields()
                 )
             ]
-            while self.cur_token.kind == TokenKind.Pipe:
+            while self._kind == TokenKind.Pipe:
                 # More constructors
                 self._advance()
                 sumlist.append(
@@ -377,20 +426,20 @@ class ASDLParser:
     def _parse_fields(self):
         fields = []
         self._match(TokenKind.LParen)
-        while self.cur_token.kind == TokenKind.TypeId:
+        while self._kind == TokenKind.TypeId:
             typename = self._advance()
             is_seq, is_opt = self._parse_optional_field_quantifier()
-            id = self._advance() if self.cur_token.kind in self._id_kinds else None
+            id = self._advance() if self._kind in self._id_kinds else None
             fields.append(Field(typename, id, seq=is_seq, opt=is_opt))
-            if self.cur_token.kind == TokenKind.RParen:
+            if self._kind == TokenKind.RParen:
                 break
-            elif self.cur_token.kind == TokenKind.Comma:
+            elif self._kind == TokenKind.Comma:
                 self._advance()
         self._match(TokenKind.RParen)
         return fields
 
     def _parse_optional_fields(self):
-        if self.cur_token.kind == TokenKind.LParen:
+        if self._kind == TokenKind.LParen:
             return self._parse_fields()
         else:
             return None
@@ -404,10 +453,10 @@ class ASDLParser:
 
     def _parse_optional_field_quantifier(self):
         is_seq, is_opt = False, False
-        if self.cur_token.kind == TokenKind.Asterisk:
+        if self._kind == TokenKind.Asterisk:
             is_seq = True
             self._advance()
-        elif self.cur_token.kind == TokenKind.Question:
+        elif self._kind == TokenKind.Question:
             is_opt = True
             self._advance()
         return is_seq, is_opt
@@ -416,11 +465,16 @@ class ASDLParser:
         """Return the value of the current token and read the next one into
         self.cur_token.
         """
-        cur_val = None if self.cur_token is None else self.cur_token.value
-        try:
-            self.cur_token = next(self._tokenizer)
-        except StopIteration:
-            self.cur_token = None
+        cur_val = self._value
+        if self._pos < self._end:
+            self._pos += 1
+        self._value = value = self._values[self._pos]
+        kind = _kinds.get(value)
+        if kind is None and value is not None:
+            kind = _kinds[value] = _kind(value)
+        self._kind = kind
+        if kind == _Invalid:
+            raise ASDLSyntaxError("Invalid operator %s" % value, self._lineno)
         return cur_val
 
     _id_kinds = (TokenKind.ConstructorId, TokenKind.TypeId)
@@ -433,21 +487,14 @@ class ASDLParser:
         * Returns the value of the current token
         * Reads in the next token
         """
-        if (
-            isinstance(kind, tuple)
-            and self.cur_token.kind in kind
-            or self.cur_token.kind == kind
-        ):
-            value = self.cur_token.value
+        if self._kind == kind or isinstance(kind, tuple) and self._kind in kind:
+            value = self._value
             self._advance()
             return value
         else:
             raise ASDLSyntaxError(
-                "Unmatched {} (found {})".format(kind, self.cur_token.kind),
-                self.cur_token.lineno,
+                "Unmatched {} (found {})".format(kind, self._kind), self._lineno
             )
 
     def _at_keyword(self, keyword):
-        return (
-            self.cur_token.kind == TokenKind.TypeId and self.cur_token.value == keyword
-        )
+        return self._kind == TokenKind.TypeId and self._value == keyword
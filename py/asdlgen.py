@@ -0,0 +1,218 @@
+# generates python source for compact node classes from an ASDL schema: one
+# class per constructor (per product), with __slots__ instead of a __dict__
+# and tuples instead of lists for sequences, plus from_ast/to_ast converters
+# between them and the ast module's nodes
+# usage: asdlgen.py [Python.asdl] > nodes.py, or asdlgen.load() for the module
+
+import ast, asdl
+import functools, os, sys, types
+import asttransfer
+
+_prelude = '''\
+# generated by asdlgen.py from {name}, do not edit
+import ast, itertools
+
+
+class AST:
+    __slots__ = ()
+    _fields: tuple[str, ...] = ()
+    _attributes: tuple[str, ...] = ()
+
+    def __repr__(self):
+        args = ", ".join(f"{{i}}={{getattr(self, i)!r}}" for i in self._fields)
+        return f"{{type(self).__name__}}({{args}})"
+
+
+class _Table(dict):
+    def __missing__(self, key):
+        raise TypeError(f"can't convert {{key.__name__!r}}")
+
+
+# entries are (kids, build) like asttransfer's codecs: kids lists the child
+# nodes to convert first, build gets them back as an iterator
+def _walk(v, tab):
+    out = []
+    stack = [(v, -1)]
+    pop, push = stack.pop, stack.append
+    while stack:
+        v, k = pop()
+        kids, build = tab[type(v)]
+        if k < 0 and kids is not None:
+            ks = kids(v)
+            if ks:
+                push((v, len(ks)))
+                stack += [(i, -1) for i in reversed(ks)]
+                continue
+        if k > 0:
+            r = out[-k:]
+            del out[-k:]
+            out.append(build(v, iter(r)))
+        else:
+            out.append(build(v, iter(())))
+    return out[0]
+
+
+_ft, _tt = _Table(), _Table()
+# sequences can hold None (dict unpacking keys, missing kw_defaults)
+_ft[type(None)] = _tt[type(None)] = (None, lambda n, r: None)
+
+
+def from_ast(n: ast.AST) -> AST:
+    return _walk(n, _ft)
+
+
+def to_ast(n: AST) -> ast.AST:
+    return _walk(n, _tt)
+'''
+
+
+class EmitVisitor(asdl.VisitorBase):
+    # base for the emitters, collects the generated lines
+    def __init__(self, mod: asdl.Module):
+        super().__init__()
+        self.mod = mod
+        self.lines: list[str] = []
+
+    def emit(self, line: str, depth: int = 0):
+        self.lines.append("    " * depth + line)
+
+    def visitModule(self, mod):
+        for dfn in mod.dfns:
+            self.visit(dfn)
+
+    def visitType(self, type):
+        self.visit(type.value, str(type.name))
+
+
+class ClassVisitor(EmitVisitor):
+    # emits the node classes
+    def visitSum(self, sum, name):
+        self.emit("")
+        self.emit("")
+        self.emit(f"class {name}(AST):")
+        self.emit(f"__slots__ = {tuple(str(i.name) for i in sum.attributes)!r}", 1)
+        self.emit(f"_attributes = {tuple(str(i.name) for i in sum.attributes)!r}", 1)
+        for t in sum.types:
+            self.visit(t, name, sum.attributes)
+
+    def visitConstructor(self, cons, name, attributes):
+        self.klass(str(cons.name), name, cons.fields, attributes, False)
+
+    def visitProduct(self, prod, name):
+        self.klass(name, "AST", prod.fields, prod.attributes, True)
+
+    def klass(self, name: str, base: str, fields: list[asdl.Field], at: list[asdl.Field], own: bool):
+        fs = [str(i.name) for i in fields]
+        ats = [str(i.name) for i in at]
+        self.emit("")
+        self.emit("")
+        self.emit(f"class {name}({base}):")
+        self.emit(f"__slots__ = {tuple(fs + ats if own else fs)!r}", 1)
+        self.emit(f"_fields = {tuple(fs)!r}", 1)
+        if own:
+            self.emit(f"_attributes = {tuple(ats)!r}", 1)
+        if not fs and not ats:
+            return
+        self.emit("")
+        args = "".join(f", {i}" for i in fs) + "".join(f", {i}=None" for i in ats)
+        self.emit(f"def __init__(self{args}):", 1)
+        for i in fs + ats:
+            self.emit(f"self.{i} = {i}", 2)
+
+
+class ConvertVisitor(EmitVisitor):
+    # emits one direction of the converters, from ast (to_ast=False) or to
+    # it. Kinds that can never contain further nodes (contexts, operators...)
+    # are converted inline by their parent, the others go through _walk's stack
+    def __init__(self, mod: asdl.Module, to_ast: bool):
+        super().__init__(mod)
+        self.to = to_ast
+        self.p = "_t" if to_ast else "_f"
+        self.flat = asttransfer.flat_kinds(mod)
+
+    def nested(self, f: asdl.Field) -> bool:
+        return f.type not in asdl.builtin_types and f.type not in self.flat
+
+    def value(self, f: asdl.Field, x: str) -> str:
+        # the converted value of field f, read as x off the source node
+        seq = "list" if self.to else "tuple"
+        if self.nested(f):
+            if f.seq:
+                return f"{seq}(itertools.islice(r, len({x})))"
+            return f"(next(r) if {x} is not None else None)" if f.opt else "next(r)"
+        if f.type in asdl.builtin_types:
+            return f"{seq}({x})" if f.seq else x
+        one = f"{self.p}t[type({{0}})][1]({{0}}, None)"
+        if f.seq:
+            return f"{seq}([{one.format('i')} for i in {x}])"
+        if f.opt:
+            return f"({one.format(x)} if {x} is not None else None)"
+        return one.format(x)
+
+    def kid(self, f: asdl.Field, x: str) -> str:
+        if f.seq:
+            return f"*{x}"
+        if f.opt:
+            return f"*(({x},) if {x} is not None else ())"
+        return x
+
+    def visitSum(self, sum, name):
+        for t in sum.types:
+            self.visit(t, name, sum.attributes)
+
+    def visitConstructor(self, cons, name, attributes):
+        self.conv(str(cons.name), cons.fields, attributes)
+
+    def visitProduct(self, prod, name):
+        self.conv(name, prod.fields, prod.attributes)
+
+    def conv(self, name: str, fields: list[asdl.Field], at: list[asdl.Field]):
+        if not hasattr(ast, name):
+            return  # the schema is newer than this python
+        src, dst = (name, f"ast.{name}") if self.to else (f"ast.{name}", name)
+        fn = f"{self.p}_{name}"
+        self.emit("")
+        if not fields and not at:
+            # no state at all, so one shared instance does
+            self.emit(f"{fn}_1 = {dst}()")
+            self.emit(f"{self.p}t[{src}] = (None, lambda n, r: {fn}_1)")
+            return
+        ks = [self.kid(f, f"n.{f.name}") for f in fields if self.nested(f)]
+        if ks:
+            self.emit(f"def {fn}_k(n):")
+            self.emit(f"return [{', '.join(ks)}]", 1)
+        args = [f"{f.name}={self.value(f, f'n.{f.name}')}" for f in fields]
+        if self.to:
+            args += [f"{f.name}=n.{f.name}" for f in at]
+        else:
+            args += [f"{f.name}=getattr(n, {str(f.name)!r}, None)" for f in at]
+        self.emit(f"def {fn}(n, r):")
+        self.emit(f"return {dst}({', '.join(args)})", 1)
+        self.emit(f"{self.p}t[{src}] = ({fn + '_k' if ks else 'None'}, {fn})")
+
+
+def generate(mod: asdl.Module, name: str = "Python.asdl") -> str:
+    out = [_prelude.format(name=name)]
+    for v in (ClassVisitor(mod), ConvertVisitor(mod, False), ConvertVisitor(mod, True)):
+        v.visit(mod)
+        out += v.lines
+    return "\n".join(out) + "\n"
+
+
+@functools.cache
+def load(path: str | None = None) -> types.ModuleType:
+    # the generated module for the schema at path (by default the Python.asdl
+    # next to asttransfer, as it reads it)
+    mod = asttransfer.astast if path is None else asdl.parse(path)
+    name = os.path.basename(path) if path is not None else "Python.asdl"
+    ret = types.ModuleType("nodes")
+    ret.__file__ = f"<asdlgen {name}>"
+    exec(compile(generate(mod, name), ret.__file__, "exec"), ret.__dict__)
+    return ret
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        sys.stdout.write(generate(asdl.parse(sys.argv[1]), os.path.basename(sys.argv[1])))
+    else:
+        sys.stdout.write(generate(asttransfer.astast))
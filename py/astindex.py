@@ -0,0 +1,104 @@
+# an index over a python ast, made in one walk: every node by constructor
+# name, its parent, and the nodes by line. Which fields hold child nodes comes
+# from the ASDL schema, like in asttransfer. Contexts and operators (the
+# field-less sums ast.parse shares between nodes) aren't indexed.
+# The index doesn't follow changes to the tree, make a new one after those.
+# usage: ix = Index(ast.parse(src)); ix.find("Call"); ix.parent(node)
+
+import ast, asdl
+import array, bisect, functools
+import typing
+import asttransfer
+
+
+@functools.cache
+def _kids() -> dict[type, tuple[tuple[str, bool], ...]]:
+    # per ast class, the fields holding nodes, and whether each is a sequence
+    mod = asttransfer.astast
+    shared = asttransfer.enum_kinds(mod)
+
+    def fields(fs: list[asdl.Field]) -> tuple[tuple[str, bool], ...]:
+        return tuple(
+            (str(f.name), f.seq)
+            for f in fs
+            if f.type not in asdl.builtin_types and f.type not in shared
+        )
+
+    ret = {}
+    for k, tp in mod.types.items():
+        if isinstance(tp, asdl.Product):
+            if hasattr(ast, k):
+                ret[getattr(ast, k)] = fields(tp.fields)
+        elif k not in shared:
+            for c in tp.types:
+                if hasattr(ast, str(c.name)):
+                    ret[getattr(ast, str(c.name))] = fields(c.fields)
+    return ret
+
+
+class Index:
+    # nodes of a tree in pre-order (source order), with their parents
+    def __init__(self, tree: ast.AST):
+        self.nodes: list[ast.AST] = []
+        self.parents = array.array("q")
+        self.names: dict[str, list[int]] = {}
+        self._pos: dict[int, int] = {}
+        self._lines: dict[str | None, tuple[array.array, list[int]]] = {}
+        kids = _kids()
+        nodes, parents, names, pos = self.nodes, self.parents, self.names, self._pos
+        stack: list[tuple[ast.AST, int]] = [(tree, -1)]
+        pop = stack.pop
+        while stack:
+            n, p = pop()
+            i = len(nodes)
+            nodes.append(n)
+            parents.append(p)
+            pos[id(n)] = i
+            nm = type(n).__name__
+            if nm in names:
+                names[nm].append(i)
+            else:
+                names[nm] = [i]
+            ks = []
+            for f, seq in kids.get(type(n), ()):
+                x = getattr(n, f, None)
+                if seq:
+                    ks += [j for j in x or () if j is not None]
+                elif x is not None:
+                    ks.append(x)
+            ks.reverse()
+            stack += [(j, i) for j in ks]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __contains__(self, node: ast.AST) -> bool:
+        return id(node) in self._pos
+
+    def find(self, name: str) -> list[ast.AST]:
+        # all nodes of a constructor, in source order
+        nodes = self.nodes
+        return [nodes[i] for i in self.names.get(name, ())]
+
+    def parent(self, node: ast.AST) -> ast.AST | None:
+        p = self.parents[self._pos[id(node)]]
+        return self.nodes[p] if p >= 0 else None
+
+    def ancestors(self, node: ast.AST) -> typing.Iterator[ast.AST]:
+        p = self.parents[self._pos[id(node)]]
+        while p >= 0:
+            yield self.nodes[p]
+            p = self.parents[p]
+
+    def lines(self, first: int, last: int | None = None, name: str | None = None) -> list[ast.AST]:
+        # nodes (of a constructor) starting on the lines first to last
+        if name not in self._lines:
+            # sorted by line on first use; sorting keeps source order per line
+            ps = self.names.get(name, []) if name is not None else range(len(self.nodes))
+            ps = [i for i in ps if getattr(self.nodes[i], "lineno", None) is not None]
+            ps.sort(key=lambda i: self.nodes[i].lineno)
+            self._lines[name] = (array.array("q", [self.nodes[i].lineno for i in ps]), ps)
+        ls, ps = self._lines[name]
+        lo = bisect.bisect_left(ls, first)
+        hi = bisect.bisect_right(ls, first if last is None else last)
+        return [self.nodes[i] for i in ps[lo:hi]]
@@ -3,21 +3,175 @@
 import ast, asdl, marshal, pickle
 import typing
 import s
-import hashlib
-import sys
+import array, hashlib, struct
+import sys, os, tempfile, time, types
+import functools, itertools
 
-__version__ = "0.1.0"
+__version__ = "0.2.0"
+_readable = ("0.1.0", __version__)  # versions loads() still understands
 sl, sd = (s.s_to_py, s.py_to_s)
-astast = asdl.parse("./Python.asdl")
-with open("./Python.asdl", "rb") as fi:
-    astver = hashlib.sha256(fi.read()).hexdigest()
 no, opt, seq = range(3)
 
 
+# the schema is only read on first use, from next to this file, and the parsed
+# Module is pickled into __pycache__ keyed by the file's hash. astast and
+# astver are still available as module attributes.
+class _Schema(typing.NamedTuple):
+    mod: asdl.Module
+    ver: str
+
+
+@functools.cache
+def _schema() -> _Schema:
+    here = os.path.dirname(os.path.abspath(__file__))
+    with open(os.path.join(here, "Python.asdl"), "rb") as fi:
+        raw = fi.read()
+    ver = hashlib.sha256(raw).hexdigest()
+    pk = os.path.join(here, "__pycache__", f"Python.asdl.{ver[:16]}.pickle")
+    try:
+        with open(pk, "rb") as fi:
+            mod = pickle.load(fi)
+        if isinstance(mod, asdl.Module):
+            return _Schema(mod, ver)
+    except Exception:
+        pass  # a damaged pickle can raise nearly anything
+    mod = asdl.ASDLParser().parse(raw.decode("utf-8"))
+    _write_cache(pk, pickle.dumps(mod))
+    return _Schema(mod, ver)
+
+
+# temp files being written, until they're renamed into place
+_tmp_prefix = ".tmp-"
+
+
+def _atomic_write(fn: str, data: bytes):
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=_tmp_prefix, dir=os.path.dirname(fn))
+    try:
+        with os.fdopen(fd, "wb") as fo:
+            fo.write(data)
+        os.replace(tmp, fn)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _write_cache(fn: str, data: bytes):
+    # best effort, the directory might not be writable; left alone when
+    # python isn't writing .pyc files either
+    if sys.dont_write_bytecode:
+        return
+    try:
+        _atomic_write(fn, data)
+    except OSError:
+        pass
+
+
+def __getattr__(name: str):
+    if name == "astast":
+        return _schema().mod
+    if name == "astver":
+        return _schema().ver
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 def type_by_name(inp: str) -> asdl.Sum | asdl.Product:
-    if inp not in astast.types:
+    types = _schema().mod.types
+    if inp not in types:
         raise NameError(f"Cannot find type {inp!r}")
-    return astast.types[inp]
+    return types[inp]
+
+
+# shared with asdlgen, columnar and astindex, which lay things out from the
+# same schema (pass astast for the one this module reads)
+def enum_kinds(mod: asdl.Module) -> set[str]:
+    # the field-less sums (contexts, operators...): plain tags, and nodes that
+    # ast.parse shares between parents
+    return {
+        k
+        for k, tp in mod.types.items()
+        if isinstance(tp, asdl.Sum) and not tp.attributes and not any(c.fields for c in tp.types)
+    }
+
+
+def flat_kinds(mod: asdl.Module) -> set[str]:
+    # the kinds that can never contain further nodes: enums, and whatever is
+    # made only of builtins and other flat kinds
+    def fields(tp: asdl.Sum | asdl.Product) -> list[asdl.Field]:
+        if isinstance(tp, asdl.Product):
+            return tp.fields
+        return [f for c in tp.types for f in c.fields]
+
+    flat: set[str] = set()
+    while True:
+        new = {
+            k
+            for k, tp in mod.types.items()
+            if all(f.type in asdl.builtin_types or f.type in flat for f in fields(tp))
+        }
+        if new == flat:
+            return flat
+        flat = new
+
+
+# constants used to all go through marshal (or pickle) as hex. The common
+# ones now get readable typed atoms, and the marshal/pickle forms are only
+# the fallback (and still read, old dumps are full of them).
+_const_atoms = {"None": None, "True": True, "False": False, "...": ...}
+
+
+def dump_const(item: typing.Any) -> str:
+    t = type(item)
+    if t is str:
+        return "s_" + item
+    if t is int:
+        try:
+            return "i_" + str(item)
+        except ValueError:
+            pass  # too many digits for str()
+    elif t is float:
+        if item == item:
+            return "f_" + repr(item)
+    elif t is bytes:
+        return "b_" + item.hex()
+    elif item is None or t is bool:
+        return repr(item)
+    elif item is ...:
+        return "..."
+    try:
+        return "m_" + marshal.dumps(item).hex()
+    except:
+        return "p_" + pickle.dumps(item).hex()
+
+
+def _load_m(inp: str) -> typing.Any:
+    return marshal.loads(bytes.fromhex(inp))
+
+
+def _load_p(inp: str) -> typing.Any:
+    return pickle.loads(bytes.fromhex(inp))
+
+
+_const_loaders = {
+    "s_": str,
+    "i_": int,
+    "f_": float,
+    "b_": bytes.fromhex,
+    "m_": _load_m,
+    "p_": _load_p,
+}
+
+
+def load_const(inp: str) -> typing.Any:
+    if inp in _const_atoms:
+        return _const_atoms[inp]
+    fn = _const_loaders.get(inp[:2])
+    if fn is None:
+        raise ValueError(f"Invalid constant prefix: {inp}")
+    return fn(inp[2:])
 
 
 def dump_item(item: typing.Any, kind: str) -> s.se_type:
@@ -26,12 +180,7 @@ def dump_item(item: typing.Any, kind: str) -> s.se_type:
     if kind in ("string", "identifier"):
         return item
     if kind == "constant":
-        p = ""
-        try:
-            p = "m_" + marshal.dumps(item).hex()
-        except:
-            p = "p_" + pickle.dumps(item).hex()
-        return p
+        return dump_const(item)
     else:
         return dump_node(item, kind)
 
@@ -45,45 +194,10 @@ def dump_single(item: typing.Any, kind: asdl.Field) -> s.se_type:
 
 
 def dump_node(item: ast.AST, kind: str) -> s.se_type:
-    tp = type_by_name(kind)
-    if isinstance(tp, asdl.Product):
-        q = []
-        for f in tp.fields:
-            assert f.name
-            c = getattr(item, f.name)
-            q.append(dump_single(c, f))
-        if not len(tp.attributes):
-            return tuple(q)
-        at = []
-        for f in tp.attributes:
-            assert f.name
-            c = getattr(item, f.name)
-            at.append(dump_single(c, f))
-        q.append(tuple(at))
-        return tuple(q)
-    q = []
-    nm = type(item).__name__
-    q.append(nm)
-    c = None
-    for i in tp.types:
-        if i.name == nm:
-            c = i
-            break
-    if c is None:
-        raise TypeError(f"{nm!r} is not a constructor of {kind!r}")
-    for f in c.fields:
-        assert f.name
-        elem = getattr(item, f.name)
-        q.append(dump_single(elem, f))
-    if not len(tp.attributes):
-        return tuple(q)
-    at = []
-    for i in tp.attributes:
-        assert i.name
-        el = getattr(item, i.name)
-        at.append(dump_single(el, i))
-    q.append(tuple(at))
-    return tuple(q)
+    fn = _codecs().dump.get(kind)
+    if fn is None:
+        type_by_name(kind)
+    return fn(item)
 
 
 def load_item(inp: s.se_type, kind: str):
@@ -95,45 +209,15 @@ def load_item(inp: s.se_type, kind: str):
         return inp
     if kind == "constant":
         assert isinstance(inp, str)
-        if inp.startswith("m_"):
-            return marshal.loads(bytes.fromhex(inp[2:]))
-        elif inp.startswith("p_"):
-            return pickle.loads(bytes.fromhex(inp[2:]))
-        else:
-            raise ValueError(f"Invalid constant prefix: {inp}")
+        return load_const(inp)
     return load_node(inp, kind)
 
 
 def load_node(inp: s.se_type, kind: str) -> ast.AST:
-    il = list(inp)
-    tp = type_by_name(kind)
-    attr, fields = (None, None)
-    mnm = kind
-    if isinstance(tp, asdl.Product):
-        attr = tp.attributes
-        fields = tp.fields
-    else:
-        mnm = il.pop(0)
-        assert isinstance(mnm, str)
-        attr = tp.attributes
-        for i in tp.types:
-            if i.name == mnm:
-                fields = i.fields
-                break
-        if fields is None:
-            raise TypeError(f"{mnm!r} is not a constructor of {kind!r}")
-    node = getattr(ast, mnm)()
-    for i in fields:
-        c = load_single(il.pop(0), i)
-        assert i.name
-        setattr(node, i.name, c)
-    if len(attr):
-        at = list(il.pop(0))
-        for i in attr:
-            c = load_single(at.pop(0), i)
-            assert i.name
-            setattr(node, i.name, c)
-    return node
+    fn = _codecs().load.get(kind)
+    if fn is None:
+        type_by_name(kind)
+    return fn(inp)
 
 
 def load_single(inp: s.se_type, kind: asdl.Field):
@@ -144,23 +228,781 @@ def load_single(inp: s.se_type, kind: asdl.Field):
     return load_item(inp, kind.type)
 
 
+# dump_node/load_node used to look every node's type up in the schema and scan
+# its constructors. Instead, the schema is compiled once into generated,
+# straight-line code per constructor, and sum types dispatch on the ast class
+# (dumping) or constructor atom (loading) through a dict.
+#
+# Nothing recurses, so arbitrarily deep trees work: each constructor gets an
+# entry (kids, build). kids lists the child nodes with their entries, and
+# build assembles the result, taking the already converted children from an
+# iterator in the same order. _walk drives both over an explicit stack.
+# Kinds that can never contain further nodes (contexts, operators, alias...)
+# are converted inline by their parent instead.
+class _Table(dict):
+    def __init__(self, kind: str):
+        self.kind = kind
+
+    def __missing__(self, key):
+        nm = getattr(key, "__name__", key)
+        raise TypeError(f"{nm!r} is not a constructor of {self.kind!r}")
+
+
+_entry = tuple[typing.Callable | None, typing.Callable]
+
+
+class _Codecs(typing.NamedTuple):
+    dump: dict[str, typing.Callable[[ast.AST], s.se_type]]
+    load: dict[str, typing.Callable[[s.se_type], ast.AST]]
+    source: str
+
+
+def _walk(v: typing.Any, e: _entry) -> typing.Any:
+    out = []
+    stack = [(v, e)]
+    pop, push = stack.pop, stack.append
+    while stack:
+        f = pop()
+        if len(f) == 3:
+            v, e, k = f
+            r = out[-k:]
+            del out[-k:]
+            out.append(e[1](v, iter(r)))
+            continue
+        v, e = f
+        if e[0] is not None:
+            kids = e[0](v)
+            if kids:
+                push((v, e, len(kids)))
+                kids.reverse()
+                stack += kids
+                continue
+        out.append(e[1](v, None))
+    return out[0]
+
+
+def _gen_codecs() -> _Codecs:
+    astast = _schema().mod
+    sums = {k for k, v in astast.types.items() if isinstance(v, asdl.Sum)}
+
+    def ctors(kind: str) -> list[tuple[str | None, str, list[asdl.Field]]]:
+        tp = astast.types[kind]
+        if isinstance(tp, asdl.Product):
+            return [(None, kind, tp.fields)]
+        return [(c.name, c.name, c.fields) for c in tp.types]
+
+    flat = flat_kinds(astast)
+
+    def nested(t: str) -> bool:
+        return t not in asdl.builtin_types and t not in flat
+
+    def dumpi(t: str, x: str) -> str:
+        if t == "int":
+            return f"str({x})"
+        if t in ("string", "identifier"):
+            return x
+        if t == "constant":
+            return f"dump_const({x})"
+        if nested(t):
+            return "next(r)"
+        if t in sums:
+            return f"_dt_{t}[type({x})][1]({x}, None)"
+        return f"_d_{t}({x}, None)"
+
+    def loadi(t: str, x: str) -> str:
+        if t == "int":
+            return f"int({x})"
+        if t in ("string", "identifier"):
+            return x
+        if t == "constant":
+            return f"load_const({x})"
+        if nested(t):
+            return "next(r)"
+        if t in sums:
+            return f"_lt_{t}[{x}[0]][1]({x}, None)"
+        return f"_l_{t}({x}, None)"
+
+    def dumpk(t: str, x: str, item: bool = False) -> str:
+        return f"({x}, _dt_{t}[type({x})])" if t in sums else f"({x}, _de_{t})"
+
+    def loadk(t: str, x: str, item: bool = False) -> str:
+        if t not in sums:
+            return f"({x}, _le_{t})"
+        # sequence items can be None (a dict's ** entries, kw_defaults), as ()
+        return f"({x}, _lt_{t}[{x}[0] if {x} else None])" if item else f"({x}, _lt_{t}[{x}[0]])"
+
+    def field(f: asdl.Field, v: str, item, none: str, empty: str, seq: str) -> str:
+        if f.seq:
+            return seq.format(f"[{item(f.type, 'i')} for i in {v}]")
+        if f.opt:
+            return f"({none} if {v}{empty} else {item(f.type, v)})"
+        return item(f.type, v)
+
+    def kids(f: asdl.Field, v: str, kid, empty: str) -> str:
+        if f.seq:
+            return f"*[{kid(f.type, 'i', True)} for i in {v}]"
+        if f.opt:
+            return f"*(() if {v}{empty} else ({kid(f.type, v)},))"
+        return kid(f.type, v)
+
+    out = []
+    tables = []
+    for kind, tp in astast.types.items():
+        if kind in sums:
+            out.append(f"_dt_{kind} = _Table({kind!r})")
+            out.append(f"_lt_{kind} = _Table({kind!r})")
+            out.append(f"_dt_{kind}[type(None)] = (None, lambda n, r: ())")
+            out.append(f"_lt_{kind}[None] = (None, lambda n, r: None)")
+        at = tp.attributes
+        for tag, nm, fields in ctors(kind):
+            fn = f"{kind}_{nm}" if tag else kind
+            off = 1 if tag else 0
+            dv = [f"n.{f.name}" for f in fields]
+            lv = [f"n[{i + off}]" for i in range(len(fields))]
+            dumpf = lambda f, v: field(f, v, dumpi, "()", " is None", "tuple({})")
+            loadf = lambda f, v: f"{f.name}={field(f, v, loadi, 'None', ' == ()', '{}')}"
+            ds = [repr(tag)] if tag else []
+            ds += [dumpf(f, v) for f, v in zip(fields, dv)]
+            if at:
+                ds.append("(" + "".join(dumpf(f, f"n.{f.name}") + ", " for f in at) + ")")
+            ls = [loadf(f, v) for f, v in zip(fields, lv)]
+            ls += [loadf(f, f"a[{i}]") for i, f in enumerate(at)]
+            ks = [(f, dv[i], lv[i]) for i, f in enumerate(fields) if nested(f.type)]
+            if ks:
+                out.append(f"def _dk_{fn}(n):")
+                out.append(f"    return [{', '.join(kids(f, d, dumpk, ' is None') for f, d, l in ks)}]")
+                out.append(f"def _lk_{fn}(n):")
+                out.append(f"    return [{', '.join(kids(f, l, loadk, ' == ()') for f, d, l in ks)}]")
+            out.append(f"def _d_{fn}(n, r):")
+            out.append(f"    return ({''.join(i + ', ' for i in ds)})")
+            out.append(f"def _l_{fn}(n, r):")
+            if at:
+                out.append(f"    a = n[{len(fields) + off}]")
+            out.append(f"    return ast.{nm}({', '.join(ls)})")
+            k = "_dk_" + fn if ks else "None"
+            out.append(f"_de_{fn} = ({k}, _d_{fn})")
+            out.append(f"_le_{fn} = ({k.replace('_dk_', '_lk_')}, _l_{fn})")
+            if tag and hasattr(ast, nm):
+                tables.append(f"_dt_{kind}[ast.{nm}] = _de_{fn}")
+                tables.append(f"_lt_{kind}[{tag!r}] = _le_{fn}")
+    src = "\n".join(out + tables) + "\n"
+    # compiling the generated code is most of the startup cost, so the code
+    # object is kept in __pycache__ too, keyed by the generated source and
+    # the interpreter (marshalled code only loads on the python that made it)
+    key = hashlib.sha256(src.encode()).hexdigest()[:16]
+    pc = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+    pc = os.path.join(pc, f"asttransfer.codecs.{sys.implementation.cache_tag}.{key}.marshal")
+    try:
+        with open(pc, "rb") as fi:
+            co = marshal.load(fi)
+    except Exception:
+        co = None
+    # anything unreadable, or not a code object, is a miss
+    if not isinstance(co, types.CodeType):
+        co = compile(src, "<asttransfer codecs>", "exec")
+        _write_cache(pc, marshal.dumps(co))
+    ns = {"ast": ast, "_Table": _Table, "dump_const": dump_const, "load_const": load_const}
+    exec(co, ns)
+    dump, load = {}, {}
+    for kind in astast.types:
+        if kind in sums:
+            dt, lt = ns[f"_dt_{kind}"], ns[f"_lt_{kind}"]
+            dump[kind] = lambda n, dt=dt: _walk(n, dt[type(n)])
+            load[kind] = lambda n, lt=lt: _walk(n, lt[n[0]])
+        else:
+            de, le = ns[f"_de_{kind}"], ns[f"_le_{kind}"]
+            dump[kind] = lambda n, de=de: _walk(n, de)
+            load[kind] = lambda n, le=le: _walk(n, le)
+    return _Codecs(dump, load, src)
+
+
+@functools.cache
+def _codecs() -> _Codecs:
+    return _gen_codecs()
+
+
 def dumps(inp: ast.AST, /, *, indent: str | int | None = None) -> str:
-    return sd(("AST", (__version__, astver), dump_node(inp, "mod")), indent=indent)
+    return sd(("AST", (__version__, _schema().ver), dump_node(inp, "mod")), indent=indent)
 
 
 def loads(inp: str) -> ast.AST:
     c = sl(inp)
-    if c[0] != "AST" or c[1] != (__version__, astver):
+    if c[0] != "AST" or c[1] not in [(i, _schema().ver) for i in _readable]:
         raise ValueError("Invalid or outdated AST")
     return load_node(c[2], "mod")
 
 
+# streaming form of a Module, for files too big to hold as one nested tuple:
+# a header ("AST-STREAM" (version astver) Module <n>), then each of the n
+# statements of the body as its own top-level form, then the type_ignores.
+# Only one statement is ever converted at a time, in either direction.
+def dump(inp: ast.Module, fp: typing.IO[str], /, *, indent: str | int | None = None):
+    if not isinstance(inp, ast.Module):
+        raise TypeError(f"only a Module can be streamed, not {type(inp).__name__!r}")
+    head = ("AST-STREAM", (__version__, _schema().ver), "Module", str(len(inp.body)))
+    s.dump(head, fp, indent=indent)
+    fp.write("\n")
+    for i in inp.body:
+        s.dump(dump_node(i, "stmt"), fp, indent=indent)
+        fp.write("\n")
+    s.dump(tuple(dump_node(i, "type_ignore") for i in inp.type_ignores), fp, indent=indent)
+    fp.write("\n")
+
+
+def _stream_head(forms: typing.Iterator[s.se_type]) -> s.se_type:
+    c = next(forms, None)
+    if not c or c[0] not in ("AST", "AST-STREAM") or c[1] not in [(i, _schema().ver) for i in _readable]:
+        raise ValueError("Invalid or outdated AST")
+    return c
+
+
+def _body_forms(c: s.se_type, forms: typing.Iterator[s.se_type]) -> typing.Iterator[s.se_type]:
+    for _ in range(int(c[3])):
+        yield _next_form(forms)
+
+
+def _next_form(forms: typing.Iterator[s.se_type]) -> s.se_type:
+    f = next(forms, None)
+    if f is None:
+        raise ValueError("AST stream ends early")
+    return f
+
+
+def _iter_body(c: s.se_type, forms: typing.Iterator[s.se_type]) -> typing.Iterator[ast.stmt]:
+    for f in _body_forms(c, forms):
+        yield load_node(f, "stmt")
+
+
+def iter_load(fp: typing.IO) -> typing.Iterator[ast.stmt]:
+    # the statements of a streamed Module, one at a time
+    forms = s.iter_forms(fp)
+    c = _stream_head(forms)
+    if c[0] != "AST-STREAM":
+        raise ValueError("Not an AST stream")
+    yield from _iter_body(c, forms)
+
+
+def load(fp: typing.IO) -> ast.AST:
+    # reads both the streamed and the plain (dumps) form
+    forms = s.iter_forms(fp)
+    c = _stream_head(forms)
+    if c[0] == "AST":
+        return load_node(c[2], "mod")
+    body = list(_iter_body(c, forms))
+    return ast.Module(body, [load_node(i, "type_ignore") for i in _next_form(forms)])
+
+
+# structural (Merkle) hashes of dumped nodes: each node's digest covers its
+# constructor, its plain fields and the digests of its child nodes, built
+# bottom-up, so equal digests mean equal subtrees. Locations are left out
+# unless asked for, so moving code around only changes the moved nodes.
+@functools.cache
+def _fields(kind: str) -> tuple[int, dict[str | None, list[asdl.Field]]]:
+    tp = type_by_name(kind)
+    if isinstance(tp, asdl.Product):
+        return 0, {None: tp.fields}
+    return 1, {c.name: c.fields for c in tp.types}
+
+
+def _node_fields(v: s.se_type, kind: str) -> tuple[str | None, list[tuple[asdl.Field, s.se_type]]]:
+    off, fs = _fields(kind)
+    ctor = v[0] if off else None
+    if ctor not in fs:
+        raise TypeError(f"{ctor!r} is not a constructor of {kind!r}")
+    return ctor, [(f, v[off + i]) for i, f in enumerate(fs[ctor])]
+
+
+@functools.cache
+def _plan(kind: str) -> dict[str | None, tuple[int, tuple[tuple[int, int, str], ...]]]:
+    # per constructor: where its fields start and, for each, (index, how, kind)
+    # with how 0 plain, 1 sequence of nodes, 2 optional node, 3 node
+    off, fs = _fields(kind)
+
+    def how(f: asdl.Field) -> int:
+        return 0 if f.type in asdl.builtin_types else 1 if f.seq else 2 if f.opt else 3
+
+    return {c: (off, tuple((off + i, how(f), f.type) for i, f in enumerate(v))) for c, v in fs.items()}
+
+
+class Hashes:
+    # digests of the nodes of a dump (see hashes), in pre-order. sizes has
+    # each node's subtree size, so a node's children are found from its index
+    # without the rest of the tree. Plain bytes and an array, so it can be
+    # kept with the dump (Cache.hashes does) and handed to diff later instead
+    # of hashing the tree again
+    def __init__(self, digests: bytes, sizes: array.array):
+        if len(digests) != 16 * len(sizes):
+            raise ValueError("digests and sizes don't match")
+        self.digests = digests
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __eq__(self, o):
+        return isinstance(o, Hashes) and self.digests == o.digests and self.sizes == o.sizes
+
+    def digest(self, i: int) -> bytes:
+        return self.digests[16 * i : 16 * i + 16]
+
+    def kids(self, v: s.se_type, kind: str, i: int) -> list[typing.Any]:
+        # per field of v (node i): the index of its node, a list of them for
+        # sequences (None for missing nodes), None for plain fields
+        p = _plan(kind)
+        p = p[None] if None in p else p[v[0]]
+        out: list[typing.Any] = []
+        pos = i + 1
+        sizes = self.sizes
+        for x, c, _ in ((v[j], c, t) for j, c, t in p[1]):
+            if c == 0:
+                out.append(None)
+            elif c == 1:
+                ks = []
+                for j in x:
+                    if j == ():
+                        ks.append(None)
+                    else:
+                        ks.append(pos)
+                        pos += sizes[pos]
+                out.append(ks)
+            elif x == ():
+                out.append(None)
+            else:
+                out.append(pos)
+                pos += sizes[pos]
+        return out
+
+
+def hashes(inp: s.se_type, kind: str = "mod", /, *, attributes: bool = False) -> Hashes:
+    # Merkle digests of every node tuple in inp, bottom-up
+    dig: list[typing.Any] = []
+    sizes = array.array("I")
+    stack: list[typing.Any] = [(inp, kind, None, 0)]
+    pop, push = stack.pop, stack.append
+    while stack:
+        v, k, p, n = pop()
+        if p is None:
+            pl = _plan(k)
+            p = pl[None] if None in pl else pl.get(v[0])
+            if p is None:
+                raise TypeError(f"{v[0]!r} is not a constructor of {k!r}")
+            n = len(dig)
+            dig.append(None)
+            sizes.append(0)
+            push((v, k, p, n))
+            kids = []
+            for i, c, t in p[1]:
+                x = v[i]
+                if c == 1:
+                    kids += [(j, t, None, 0) for j in x if j != ()]
+                elif c == 3 or c == 2 and x != ():
+                    kids.append((x, t, None, 0))
+            kids.reverse()
+            stack += kids
+            continue
+        sizes[n] = len(dig) - n
+        off, fs = p
+        h = [v[0].encode() if off else b""]
+        pos = n + 1
+        for i, c, _ in fs:
+            x = v[i]
+            if c == 0:
+                h.append(b"\0" + repr(x).encode())
+            elif c == 1:
+                h.append(b"\1%d" % len(x))
+                for j in x:
+                    if j == ():
+                        h.append(b"\2")
+                    else:
+                        h.append(dig[pos])
+                        pos += sizes[pos]
+            elif x == ():
+                h.append(b"\2")
+            else:
+                h.append(b"\3" + dig[pos])
+                pos += sizes[pos]
+        if attributes and len(v) > off + len(fs):
+            h.append(b"\4" + repr(v[-1]).encode())
+        dig[n] = hashlib.blake2b(b"".join(h), digest_size=16).digest()
+    return Hashes(b"".join(dig), sizes)
+
+
+class Change(typing.NamedTuple):
+    op: str  # "added", "removed" or "changed"
+    path: str  # like body[3].value.args[0], indices of removed ones are old
+    old: s.se_type | None
+    new: s.se_type | None
+
+
+def diff(
+    a: s.se_type,
+    b: s.se_type,
+    kind: str = "mod",
+    /,
+    *,
+    attributes: bool = False,
+    ha: Hashes | None = None,
+    hb: Hashes | None = None,
+) -> typing.Iterator[Change]:
+    # compares two dumped nodes, only descending where the hashes differ.
+    # Sequences are aligned on their children's hashes (difflib). ha and hb
+    # are a's and b's hashes() (with the same attributes), if already known;
+    # only a side without them gets hashed
+    import difflib
+
+    if ha is None:
+        ha = hashes(a, kind, attributes=attributes)
+    if hb is None:
+        hb = hashes(b, kind, attributes=attributes)
+    da, db = ha.digest, hb.digest
+    # (node in a, in b, kind, index in ha, in hb, path); paths are b's, but
+    # the last index of a removed node is a's
+    stack: list[typing.Any] = [(a, b, kind, 0, 0, "")]
+    while stack:
+        f = stack.pop()
+        if isinstance(f, Change):
+            yield f
+            continue
+        a, b, k, ia, ib, path = f
+        if a == () or b == ():
+            if a != b:
+                stack.append(Change("changed", path, a or None, b or None))
+            continue
+        if da(ia) == db(ib):
+            continue
+        ca, fa = _node_fields(a, k)
+        cb, fb = _node_fields(b, k)
+        if ca != cb:
+            stack.append(Change("changed", path or k, a, b))
+            continue
+        todo: list[typing.Any] = []
+        for (fl, x), (_, y), ka, kb in zip(fa, fb, ha.kids(a, k, ia), hb.kids(b, k, ib)):
+            p = f"{path}.{fl.name}" if path else str(fl.name)
+            if fl.type in asdl.builtin_types:
+                if x != y:
+                    todo.append(Change("changed", p, x, y))
+            elif fl.seq:
+                sm = difflib.SequenceMatcher(
+                    None,
+                    [da(i) if i is not None else b"" for i in ka],
+                    [db(i) if i is not None else b"" for i in kb],
+                    autojunk=False,
+                )
+                for op, i1, i2, j1, j2 in sm.get_opcodes():
+                    if op == "equal":
+                        continue
+                    if op == "replace" and _fields(fl.type)[0]:
+                        # pair up the differing runs by constructor
+                        sm2 = difflib.SequenceMatcher(
+                            None, [i[:1] for i in x[i1:i2]], [i[:1] for i in y[j1:j2]], autojunk=False
+                        )
+                        ops = [
+                            (o, i1 + a1, i1 + a2, j1 + b1, j1 + b2)
+                            for o, a1, a2, b1, b2 in sm2.get_opcodes()
+                        ]
+                    else:
+                        ops = [(op, i1, i2, j1, j2)]
+                    for op, i1, i2, j1, j2 in ops:
+                        n = min(i2 - i1, j2 - j1) if op in ("equal", "replace") else 0
+                        for i in range(n):
+                            i, j = i1 + i, j1 + i
+                            todo.append((x[i], y[j], fl.type, ka[i], kb[j], f"{p}[{j}]"))
+                        for i in range(i1 + n, i2):
+                            todo.append(Change("removed", f"{p}[{i}]", x[i], None))
+                        for j in range(j1 + n, j2):
+                            todo.append(Change("added", f"{p}[{j}]", None, y[j]))
+            elif fl.opt and (x == () or y == ()):
+                if x != y:
+                    todo.append(Change("added" if x == () else "removed", p, x or None, y or None))
+            elif da(ka) != db(kb):
+                todo.append((x, y, fl.type, ka, kb, p))
+        if not todo:
+            # only the locations differ
+            todo.append(Change("changed", path or k, a, b))
+        todo.reverse()
+        stack += todo
+
+
+# content-addressed on-disk cache of dumped modules, keyed by the source, the
+# schema hash and our version. Entries are binary s-expressions (s.to_bytes)
+# of the full ("AST" ...) form after the sha256 of those bytes, so a damaged
+# entry is a miss rather than a wrong tree, written atomically; reads bump the
+# mtime so eviction can drop the least recently used entries once over
+# max_bytes.
+class Cache:
+    def __init__(self, path: str, max_bytes: int = 256 << 20):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.written = 0
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, src: str | bytes) -> str:
+        h = hashlib.sha256(src.encode() if isinstance(src, str) else src)
+        h.update(f"\0{_schema().ver}\0{__version__}".encode())
+        return h.hexdigest()
+
+    def file(self, key: str) -> str:
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def get(self, src: str | bytes) -> s.se_type | None:
+        fn = self.file(self.key(src))
+        try:
+            with open(fn, "rb") as fi:
+                data = fi.read()
+            if hashlib.sha256(data[32:]).digest() != data[:32]:
+                return None
+            c = s.from_bytes(data[32:])
+        except (OSError, ValueError, TypeError, IndexError, StopIteration, struct.error):
+            return None  # missing, or unreadable: a miss either way
+        if len(c) != 3 or c[0] != "AST" or c[1] != (__version__, _schema().ver):
+            return None
+        try:
+            os.utime(fn)
+        except OSError:
+            pass
+        return c
+
+    def put(self, src: str | bytes, form: s.se_type):
+        data = s.to_bytes(form)
+        data = hashlib.sha256(data).digest() + data
+        try:
+            _atomic_write(self.file(self.key(src)), data)
+        except OSError:
+            return  # read-only or full, the entry is just missing next time
+        self.written += len(data)
+        if self.written > self.max_bytes // 16:
+            self.evict()
+
+    def hashes(self, src: str | bytes, form: s.se_type, attributes: bool = False) -> Hashes:
+        # hashes() of the dumped node of src (form[2] of a cached form, or
+        # form itself), kept next to its entry
+        fn = self.file(self.key(src)) + (".ha" if attributes else ".h")
+        head = ("HASHES", __version__, _schema().ver, sys.byteorder)
+        try:
+            with open(fn, "rb") as fi:
+                c = marshal.load(fi)
+            if c[0] == head:
+                sizes = array.array("I")
+                sizes.frombytes(c[1])
+                return Hashes(c[2], sizes)
+        except (OSError, EOFError, ValueError, TypeError, IndexError):
+            pass  # missing or unreadable, made again
+        node = form[2] if form[:1] == ("AST",) else form
+        ret = hashes(node, "mod", attributes=attributes)
+        data = marshal.dumps((head, ret.sizes.tobytes(), ret.digests))
+        try:
+            _atomic_write(fn, data)
+            self.written += len(data)
+        except OSError:
+            pass
+        return ret
+
+    def evict(self):
+        # other processes' temp files are left alone, unless they're too old
+        # to still be in use
+        self.written = 0
+        ents = []
+        now = time.time()
+        for root, _, files in os.walk(self.path):
+            for i in files:
+                try:
+                    st = os.stat(os.path.join(root, i))
+                except FileNotFoundError:
+                    continue
+                if i.startswith(_tmp_prefix) and now - st.st_mtime < 3600:
+                    continue
+                ents.append((st.st_mtime, st.st_size, os.path.join(root, i)))
+        total = sum(i[1] for i in ents)
+        ents.sort()
+        for _, size, fn in ents:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(fn)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def _dump_source(
+    src: str, filename: str, cache: Cache | None, load: bool = False
+) -> tuple[s.se_type, ast.AST | None]:
+    # the dumped form of src, and its tree when it had to be parsed (or with
+    # load, always). A cached form that doesn't load is a miss, and replaced
+    if cache is not None:
+        c = cache.get(src)
+        if c is not None:
+            if not load:
+                return c, None
+            try:
+                return c, load_node(c[2], "mod")
+            except Exception:
+                pass
+    at = ast.parse(src, filename, "exec")
+    c = ("AST", (__version__, _schema().ver), dump_node(at, "mod"))
+    if cache is not None:
+        cache.put(src, c)
+    return c, at
+
+
+def parse(src: str, filename: str = "<unknown>", cache: Cache | None = None) -> ast.AST:
+    # ast.parse, skipped when the cache already has this source
+    return _dump_source(src, filename, cache, load=True)[1]
+
+
+_caches: dict[str, Cache] = {}
+
+
+def read_node(path: str) -> s.se_type:
+    # the dumped mod node of a .py file, a dumps() file or a stream
+    if path.endswith(".py"):
+        with open(path, "r") as fi:
+            return dump_node(ast.parse(fi.read(), path, "exec"), "mod")
+    with open(path, "r") as fi:
+        forms = s.iter_forms(fi)
+        c = _stream_head(forms)
+        if c[0] == "AST":
+            return c[2]
+        body = tuple(_body_forms(c, forms))
+        return ("Module", body, _next_form(forms))
+
+
+# .py files get dumped, anything else is taken as a dump and loaded back
+def convert_file(
+    path: str, indent: str | int | None = 2, cache: str | None = None
+) -> tuple[str, str, int]:
+    if path.endswith(".py"):
+        with open(path, "r") as fi:
+            tx = fi.read()
+        ch = None
+        if cache is not None:
+            if cache not in _caches:
+                _caches[cache] = Cache(cache)
+            ch = _caches[cache]
+        return path, sd(_dump_source(tx, path, ch)[0], indent=indent), len(tx)
+    with open(path, "r") as fi:
+        return path, ast.dump(load(fi)), os.path.getsize(path)
+
+
+def _convert_safe(
+    path: str, indent: str | int | None, cache: str | None
+) -> tuple[str, str | Exception, int]:
+    try:
+        return convert_file(path, indent, cache)
+    except Exception as e:
+        return path, e, 0
+
+
+def find_files(paths: typing.Iterable[str]) -> list[str]:
+    ret = []
+    for p in paths:
+        if not os.path.isdir(p):
+            ret.append(p)
+            continue
+        for root, dirs, files in os.walk(p):
+            dirs.sort()
+            ret += [os.path.join(root, i) for i in sorted(files) if i.endswith(".py")]
+    return ret
+
+
+def map_files(
+    each: typing.Callable[..., tuple[str, str | Exception, int]],
+    paths: typing.Iterable[str],
+    /,
+    *args: typing.Any,
+    jobs: int | None = None,
+) -> typing.Iterator[tuple[str, str | Exception, int]]:
+    # each(path, *args) over a process pool, results in input order; each
+    # should return failures as the exception rather than raise
+    paths = list(paths)
+    jobs = jobs or os.cpu_count() or 1
+    rep = [itertools.repeat(i) for i in args]
+    if jobs == 1 or len(paths) < 2:
+        yield from map(each, paths, *rep)
+        return
+    import concurrent.futures
+
+    chunk = max(1, len(paths) // (jobs * 4))
+    with concurrent.futures.ProcessPoolExecutor(jobs) as ex:
+        yield from ex.map(each, paths, *rep, chunksize=chunk)
+
+
+def write_results(
+    results: typing.Iterable[tuple[str, str | Exception, int]], write: typing.Callable[[str], typing.Any]
+):
+    # writes out what map_files returns, failures to stderr, then a summary
+    t = time.perf_counter()
+    n = size = 0
+    for path, out, sz in results:
+        if isinstance(out, Exception):
+            print(f"{path}: {type(out).__name__}: {out}", file=sys.stderr)
+            continue
+        write(out)
+        n += 1
+        size += sz
+    dt = time.perf_counter() - t
+    print(
+        f"{n} files, {size / 1e6:.2f} MB in {dt:.2f}s"
+        f" ({n / dt:.1f} files/s, {size / 1e6 / dt:.2f} MB/s)",
+        file=sys.stderr,
+    )
+
+
+def convert_files(
+    paths: typing.Iterable[str],
+    /,
+    *,
+    jobs: int | None = None,
+    indent: str | int | None = 2,
+    cache: str | None = None,
+) -> typing.Iterator[tuple[str, str | Exception, int]]:
+    # results come back in input order, failures as the exception
+    return map_files(_convert_safe, paths, indent, cache, jobs=jobs)
+
+
 if __name__ == "__main__":
-    with open(sys.argv[1], "r") as fi:
-        tx = fi.read()
-    if sys.argv[1].endswith(".py"):
-        at = ast.parse(tx, "exec")
-        print(dumps(at, indent=2))
-    else:
-        at = loads(tx)
-        print(ast.dump(at))
+    import argparse
+
+    ap = argparse.ArgumentParser(description="convert python files to/from s-expressions")
+    ap.add_argument("paths", nargs="+", help=".py files to dump, dumps to load, or dirs")
+    ap.add_argument("-j", "--jobs", type=int, default=None)
+    ap.add_argument("--indent", type=int, default=2)
+    ap.add_argument("--cache", metavar="DIR", help="reuse dumps of unchanged files")
+    ap.add_argument("--stream", action="store_true", help="dump one statement at a time")
+    ap.add_argument("--diff", action="store_true", help="show what changed between two files")
+    ap.add_argument("--locations", action="store_true", help="let --diff compare locations too")
+    args = ap.parse_args()
+    if args.diff:
+        if len(args.paths) != 2:
+            ap.error("--diff takes exactly two files")
+        ns, hs = [], []
+        for i in args.paths:
+            if args.cache and i.endswith(".py"):
+                # dumps and hashes of unchanged files come from the cache
+                ch = Cache(args.cache)
+                with open(i, "r") as fi:
+                    tx = fi.read()
+                c = _dump_source(tx, i, ch)[0]
+                ns.append(c[2])
+                hs.append(ch.hashes(tx, c, args.locations))
+            else:
+                ns.append(read_node(i))
+                hs.append(None)
+        for c in diff(*ns, attributes=args.locations, ha=hs[0], hb=hs[1]):
+            x, y = (sd((i,))[1:-1] if i is not None else "" for i in (c.old, c.new))
+            if len(x) > 60:
+                x = x[:57] + "..."
+            if len(y) > 60:
+                y = y[:57] + "..."
+            print(f"{c.op:<8} {c.path}: {x}{' -> ' if x and y else ''}{y}")
+        sys.exit()
+    if len(args.paths) == 1 and args.jobs is None and not os.path.isdir(args.paths[0]):
+        if args.stream and args.paths[0].endswith(".py"):
+            with open(args.paths[0], "r") as fi:
+                at = ast.parse(fi.read(), args.paths[0], "exec")
+            dump(at, sys.stdout, indent=args.indent)
+            sys.exit()
+        print(convert_file(args.paths[0], args.indent, args.cache)[1])
+        sys.exit()
+    files = find_files(args.paths)
+    write_results(convert_files(files, jobs=args.jobs, indent=args.indent, cache=args.cache), print)
@@ -0,0 +1,828 @@
+# rough benchmarks for the s-expression / ast tools
+# usage: bench.py <what> [source files...]
+# (defaults to a chunk of the stdlib as corpus)
+
+import ast, glob, io, json, os, sys, tempfile, time, tracemalloc
+import typing
+import s
+
+import asttransfer
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+
+def corpus(files: list[str], limit: int = 200) -> list[str]:
+    if not files:
+        files = sorted(glob.glob(os.path.join(os.path.dirname(os.__file__), "*.py")))
+    ret = []
+    for fn in files[:limit]:
+        with open(fn, "r", encoding="utf-8") as fi:
+            ret.append(fi.read())
+    return ret
+
+
+def timed(fn, *args, n: int = 1):
+    best = float("inf")
+    ret = None
+    for _ in range(n):
+        t = time.perf_counter()
+        ret = fn(*args)
+        best = min(best, time.perf_counter() - t)
+    return best, ret
+
+
+def report(name: str, size: int, dt: float):
+    print(f"{name:<24} {dt * 1000:10.1f} ms {size / dt / 1e6:10.2f} MB/s")
+
+
+# the parser as it was before the regex scanner, kept for comparison
+def old_s_to_py(inp: str):
+    cm = {"x": 2, "u": 4, "U": 8}
+    stack = []
+    q = list(inp)[::-1]
+    quot = ""
+    while q:
+        cur = q.pop()
+        if cur.isspace():
+            continue
+        if cur == ";":
+            while q and q[-1] != "\n":
+                q.pop()
+            continue
+        if cur == "(":
+            stack.append([])
+            continue
+        if cur == ")":
+            if len(stack) == 1:
+                return tuple(stack.pop())
+            stack[-2].append(tuple(stack.pop()))
+            continue
+        if cur in "'\"":
+            cs = ""
+            quot = cur
+            while q:
+                cur = q.pop()
+                if cur == quot:
+                    break
+                if cur == "\\":
+                    es = q.pop()
+                    if es == "n":
+                        cs += "\n"
+                    elif es in cm:
+                        c = ""
+                        for _ in range(cm[es]):
+                            c += q.pop()
+                        c = int(c, base=16)
+                        cs += chr(c)
+                    else:
+                        cs += es
+                else:
+                    cs += cur
+            stack[-1].append(cs)
+            continue
+        cs = cur
+        while not q[-1].isspace() and q[-1] not in ["(", ")", ";"]:
+            cs += q.pop()
+        stack[-1].append(cs)
+    raise Exception("Brackets don't close correctly")
+
+
+# the serializer as it was before, kept for comparison
+def old_escape_str(inp: str):
+    c = '"'
+    for i in inp:
+        if i == "\n":
+            c += "\\n"
+        elif ord(i) < ord(" ") or ord(i) > ord("~"):
+            if ord(i) < 0x100:
+                c += f"\\x{ord(i):02x}"
+            elif ord(i) < 0x10000:
+                c += f"\\u{ord(i):04x}"
+            else:
+                c += f"\\U{ord(i):08x}"
+        elif i == '"':
+            c += '\\"'
+        else:
+            c += i
+    return c + '"'
+
+
+def old_py_to_s(inp, indent=None) -> str:
+    ss = []
+    if isinstance(indent, int):
+        indent = " " * indent
+    for i in inp:
+        if isinstance(i, tuple):
+            ss.append(old_py_to_s(i, indent=indent))
+            continue
+        c = False
+        for j in i:
+            if j.isspace() or j in "()\"'":
+                c = True
+            if ord(j) < ord(" ") or ord(j) > ord("~"):
+                c = True
+        if not c:
+            ss.append(i)
+            continue
+        ss.append(old_escape_str(i))
+    if indent is None:
+        return "(" + " ".join(ss) + ")"
+    else:
+        if len(ss) == 0:
+            return "()"
+        if len(ss) == 1:
+            return f"({ss[0]})"
+        ret = "("
+        for i in ss:
+            for j in i.split("\n"):
+                ret += f"\n{indent}{j}"
+        return ret + "\n)"
+
+
+def dumped(srcs: list[str], indent: int | None = 1) -> list[str]:
+    return [asttransfer.dumps(ast.parse(i), indent=indent) for i in srcs]
+
+
+# asttransfer's conversion before the generated codecs, kept for comparison
+def old_dump_item(item: typing.Any, kind: str) -> typing.Any:
+    if kind == "int":
+        return str(item)
+    if kind in ("string", "identifier"):
+        return item
+    if kind == "constant":
+        p = ""
+        try:
+            p = "m_" + asttransfer.marshal.dumps(item).hex()
+        except:
+            p = "p_" + asttransfer.pickle.dumps(item).hex()
+        return p
+    else:
+        return old_dump_node(item, kind)
+
+
+def old_dump_single(item: typing.Any, kind: typing.Any) -> typing.Any:
+    if kind.opt and item is None:
+        return ()
+    if kind.seq:
+        return tuple((old_dump_item(i, kind.type) for i in item))
+    return old_dump_item(item, kind.type)
+
+
+def old_dump_node(item: ast.AST, kind: str) -> typing.Any:
+    tp = asttransfer.type_by_name(kind)
+    if isinstance(tp, asttransfer.asdl.Product):
+        q = []
+        for f in tp.fields:
+            assert f.name
+            c = getattr(item, f.name)
+            q.append(old_dump_single(c, f))
+        if not len(tp.attributes):
+            return tuple(q)
+        at = []
+        for f in tp.attributes:
+            assert f.name
+            c = getattr(item, f.name)
+            at.append(old_dump_single(c, f))
+        q.append(tuple(at))
+        return tuple(q)
+    q = []
+    nm = type(item).__name__
+    q.append(nm)
+    c = None
+    for i in tp.types:
+        if i.name == nm:
+            c = i
+            break
+    if c is None:
+        raise TypeError(f"{nm!r} is not a constructor of {kind!r}")
+    for f in c.fields:
+        assert f.name
+        elem = getattr(item, f.name)
+        q.append(old_dump_single(elem, f))
+    if not len(tp.attributes):
+        return tuple(q)
+    at = []
+    for i in tp.attributes:
+        assert i.name
+        el = getattr(item, i.name)
+        at.append(old_dump_single(el, i))
+    q.append(tuple(at))
+    return tuple(q)
+
+
+def old_load_item(inp: typing.Any, kind: str):
+    if kind == "int":
+        assert isinstance(inp, str)
+        return int(inp)
+    if kind in ("string", "identifier"):
+        assert isinstance(inp, str)
+        return inp
+    if kind == "constant":
+        assert isinstance(inp, str)
+        if inp.startswith("m_"):
+            return asttransfer.marshal.loads(bytes.fromhex(inp[2:]))
+        elif inp.startswith("p_"):
+            return asttransfer.pickle.loads(bytes.fromhex(inp[2:]))
+        else:
+            raise ValueError(f"Invalid constant prefix: {inp}")
+    return old_load_node(inp, kind)
+
+
+def old_load_node(inp: typing.Any, kind: str) -> ast.AST:
+    il = list(inp)
+    tp = asttransfer.type_by_name(kind)
+    attr, fields = (None, None)
+    mnm = kind
+    if isinstance(tp, asttransfer.asdl.Product):
+        attr = tp.attributes
+        fields = tp.fields
+    else:
+        mnm = il.pop(0)
+        assert isinstance(mnm, str)
+        attr = tp.attributes
+        for i in tp.types:
+            if i.name == mnm:
+                fields = i.fields
+                break
+        if fields is None:
+            raise TypeError(f"{mnm!r} is not a constructor of {kind!r}")
+    node = getattr(ast, mnm)()
+    for i in fields:
+        c = old_load_single(il.pop(0), i)
+        assert i.name
+        setattr(node, i.name, c)
+    if len(attr):
+        at = list(il.pop(0))
+        for i in attr:
+            c = old_load_single(at.pop(0), i)
+            assert i.name
+            setattr(node, i.name, c)
+    return node
+
+
+def old_load_single(inp: typing.Any, kind: typing.Any):
+    if kind.opt and inp == ():
+        return None
+    if kind.seq:
+        return [old_load_item(i, kind.type) for i in inp]
+    return old_load_item(inp, kind.type)
+
+
+def bench_parse(srcs: list[str]):
+    txt = dumped(srcs)
+    size = sum(len(i.encode()) for i in txt)
+    dt, new = timed(lambda: [s.s_to_py(i) for i in txt], n=3)
+    report("s_to_py", size, dt)
+    dt, old = timed(lambda: [old_s_to_py(i) for i in txt])
+    report("s_to_py (old)", size, dt)
+    assert new == old
+
+
+def bench_serialize(srcs: list[str]):
+    trees = [s.s_to_py(i) for i in dumped(srcs, None)]
+    for ind in (None, 2):
+        txt = [s.py_to_s(i, indent=ind) for i in trees]
+        size = sum(len(i.encode()) for i in txt)
+        dt, new = timed(lambda: [s.py_to_s(i, indent=ind) for i in trees], n=3)
+        report(f"py_to_s indent={ind}", size, dt)
+        dt, old = timed(lambda: [old_py_to_s(i, indent=ind) for i in trees])
+        report(f"py_to_s indent={ind} (old)", size, dt)
+        # the old one left \\ and ; in atoms unescaped, so compare by reading back
+        assert [s.s_to_py(i) for i in new] == trees
+
+
+def bench_binary(srcs: list[str]):
+    txt = dumped(srcs, None)
+    trees = [s.s_to_py(i) for i in txt]
+    bins = [s.to_bytes(i) for i in trees]
+    for t, b in zip(trees, bins):
+        assert s.from_bytes(b) == t
+        assert s.from_bytes(memoryview(bytearray(b))) == t
+        assert s.s_to_py(s.py_to_s(s.from_bytes(b))) == t
+    tsize = sum(len(i.encode()) for i in txt)
+    bsize = sum(len(i) for i in bins)
+    print(f"text {tsize / 1e6:.2f} MB, binary {bsize / 1e6:.2f} MB ({bsize / tsize:.0%})")
+    dt, _ = timed(lambda: [s.s_to_py(i) for i in txt], n=3)
+    report("s_to_py", tsize, dt)
+    dt, _ = timed(lambda: [s.from_bytes(i) for i in bins], n=3)
+    report("from_bytes", bsize, dt)
+    print(f"{'':<24} {dt * 1000:10.1f} ms {tsize / dt / 1e6:10.2f} MB/s (of text)")
+    dt, _ = timed(lambda: [s.py_to_s(i) for i in trees], n=3)
+    report("py_to_s", tsize, dt)
+    dt, _ = timed(lambda: [s.to_bytes(i) for i in trees], n=3)
+    report("to_bytes", bsize, dt)
+
+
+def bench_share(srcs: list[str]):
+    txt = "(" + "".join(dumped(srcs, None)) + ")"
+    size = len(txt.encode())
+    ref = None
+    for kw in ({}, {"intern": True}, {"share": True}):
+        dt, ret = timed(lambda: s.s_to_py(txt, **kw), n=3)
+        del ret
+        tracemalloc.start()
+        ret = s.s_to_py(txt, **kw)
+        mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        ref = ref or ret
+        assert ret == ref
+        report(f"s_to_py {kw}", size, dt)
+        print(f"{'':<24} {mem / 1e6:10.2f} MB resident")
+
+
+def bench_codec(srcs: list[str]):
+    trees = []
+    for i in srcs:
+        t = ast.parse(i)
+        try:
+            old_dump_node(t, "mod")
+        except (TypeError, RecursionError):
+            continue
+        trees.append(t)
+    size = sum(len(i.encode()) for i in srcs)
+    dt, new = timed(lambda: [asttransfer.dump_node(i, "mod") for i in trees], n=3)
+    report("dump_node", size, dt)
+    dt, old = timed(lambda: [old_dump_node(i, "mod") for i in trees])
+    report("dump_node (old)", size, dt)
+    dt, back = timed(lambda: [asttransfer.load_node(i, "mod") for i in new], n=3)
+    report("load_node", size, dt)
+    dt, oback = timed(lambda: [old_load_node(i, "mod") for i in old])
+    report("load_node (old)", size, dt)
+    for a, b, c, o in zip(back, oback, trees, old):
+        assert ast.dump(a, include_attributes=True) == ast.dump(b, include_attributes=True)
+        assert ast.dump(a, include_attributes=True) == ast.dump(c, include_attributes=True)
+        # dumps from before the typed constants still load
+        o = asttransfer.load_node(o, "mod")
+        assert ast.dump(o, include_attributes=True) == ast.dump(c, include_attributes=True)
+
+
+def bench_const(srcs: list[str]):
+    consts = []
+    for i in srcs:
+        consts.extend(n.value for n in ast.walk(ast.parse(i)) if isinstance(n, ast.Constant))
+    new = [asttransfer.dump_const(i) for i in consts]
+    old = [old_dump_item(i, "constant") for i in consts]
+    for n, o in zip(new, old):
+        a, b = asttransfer.load_const(n), asttransfer.load_const(o)
+        assert type(a) is type(b) and (a == b or a != a)
+    nsize = len(s.py_to_s(tuple(new)).encode())
+    osize = len(s.py_to_s(tuple(old)).encode())
+    print(f"{len(consts)} constants, text {nsize / 1e6:.2f} MB, marshal {osize / 1e6:.2f} MB ({nsize / osize:.0%})")
+    dt, _ = timed(lambda: [asttransfer.dump_const(i) for i in consts], n=3)
+    report("dump_const", nsize, dt)
+    dt, _ = timed(lambda: [old_dump_item(i, "constant") for i in consts], n=3)
+    report("dump_const (old)", osize, dt)
+    dt, _ = timed(lambda: [asttransfer.load_const(i) for i in new], n=3)
+    report("load_const", nsize, dt)
+    dt, _ = timed(lambda: [old_load_item(i, "constant") for i in old], n=3)
+    report("load_const (old)", osize, dt)
+
+
+def peak(fn, *args):
+    tracemalloc.start()
+    t = time.perf_counter()
+    ret = fn(*args)
+    dt = time.perf_counter() - t
+    mem = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return dt, mem, ret
+
+
+def bench_stream(srcs: list[str]):
+    # one big module made of every statement of the corpus
+    body = []
+    for i in srcs:
+        t = ast.parse(i)
+        try:
+            asttransfer.dumps(t)
+        except (TypeError, RecursionError):
+            continue
+        body += t.body
+    mod = ast.Module(body, [])
+    with tempfile.TemporaryDirectory() as d:
+        fn = os.path.join(d, "x")
+
+        def dumps():
+            with open(fn, "w") as fo:
+                fo.write(asttransfer.dumps(mod))
+
+        def dump():
+            with open(fn, "w") as fo:
+                asttransfer.dump(mod, fo)
+
+        def loads():
+            with open(fn) as fi:
+                return asttransfer.loads(fi.read())
+
+        def count():
+            with open(fn) as fi:
+                return sum(1 for _ in asttransfer.iter_load(fi))
+
+        for name, fn_ in (("dumps", dumps), ("loads", loads), ("dump", dump), ("iter_load", count)):
+            dt, mem, ret = peak(fn_)
+            report(name, os.path.getsize(fn), dt)
+            print(f"{'':<24} {mem / 1e6:10.2f} MB peak")
+            if name == "loads":
+                ref = asttransfer.dumps(ret)
+                del ret
+        assert ret == len(body)
+        with open(fn) as fi:
+            assert asttransfer.dumps(asttransfer.load(fi)) == ref
+
+
+def bench_diff(srcs: list[str]):
+    # a big module against a copy with one statement changed in the middle
+    body = []
+    for i in srcs:
+        t = ast.parse(i)
+        try:
+            asttransfer.dumps(t)
+        except (TypeError, RecursionError):
+            continue
+        body += t.body
+    a = asttransfer.dump_node(ast.Module(body, []), "mod")
+    k = len(body) // 2
+    body[k] = ast.Pass(lineno=1, col_offset=0, end_lineno=1, end_col_offset=4)
+    b = asttransfer.dump_node(ast.Module(body, []), "mod")
+    size = len(asttransfer.sd(a).encode())
+    dt, _ = timed(lambda: asttransfer.sd(a) == asttransfer.sd(b), n=3)
+    report("text compare", size, dt)
+    dt, ha = timed(lambda: asttransfer.hashes(a), n=3)
+    report("hashes", size, dt)
+    dt, ch = timed(lambda: list(asttransfer.diff(a, b)), n=3)
+    report("diff (incl. hashes)", size, dt)
+    assert [(i.op, i.path) for i in ch] == [("changed", f"body[{k}]")], ch
+    hb = asttransfer.hashes(b)
+    dt, ch2 = timed(lambda: list(asttransfer.diff(a, b, ha=ha, hb=hb)), n=3)
+    report("diff (hashes known)", size, dt)
+    assert ch2 == ch
+    with tempfile.TemporaryDirectory() as d:
+        # hashes kept next to a cache entry, as a later run would find them
+        cache = asttransfer.Cache(d)
+        cache.hashes("a", a)
+        dt, ha2 = timed(lambda: cache.hashes("a", a), n=3)
+        report("Cache.hashes (stored)", size, dt)
+        assert ha2 == ha
+
+
+def bench_nodes(srcs: list[str]):
+    import asdlgen
+
+    m = asdlgen.load()
+    size = sum(len(i.encode()) for i in srcs)
+    dt, mem, trees = peak(lambda: [ast.parse(i) for i in srcs])
+    report("ast.parse", size, dt)
+    print(f"{'':<24} {mem / 1e6:10.2f} MB held")
+    dt, mem, slot = peak(lambda: [m.from_ast(i) for i in trees])
+    report("from_ast", size, dt)
+    print(f"{'':<24} {mem / 1e6:10.2f} MB held")
+    dt, back = timed(lambda: [m.to_ast(i) for i in slot])
+    report("to_ast", size, dt)
+    for a, b in zip(trees, back):
+        assert ast.dump(a, include_attributes=True) == ast.dump(b, include_attributes=True)
+
+
+def bench_columnar(srcs: list[str]):
+    import columnar
+
+    body = []
+    for i in srcs:
+        body += ast.parse(i).body
+    mod = ast.Module(body, [])
+    size = sum(len(i.encode()) for i in srcs)
+    dt, mem, form = peak(lambda: asttransfer.dump_node(mod, "mod"))
+    report("dump_node", size, dt)
+    print(f"{'':<24} {mem / 1e6:10.2f} MB held")
+    dt, mem, st = peak(lambda: columnar.Store.from_ast(mod))
+    report("Store.from_ast", size, dt)
+    print(f"{'':<24} {mem / 1e6:10.2f} MB held ({st.nbytes() / 1e6:.2f} MB columns)")
+    assert st.to_sexpr() == form
+    del form
+
+    def walk():
+        return [
+            n
+            for n in ast.walk(mod)
+            if isinstance(n, ast.Call) and isinstance(n.func, ast.Name) and n.func.id == "print"
+        ]
+
+    dt, hits = timed(walk)
+    report("ast.walk print()", size, dt)
+    dt, ids = timed(lambda: st.where("Call", "func", st.where("Name", "id", "print")), n=5)
+    report("Store.where print()", size, dt)
+    assert len(ids) == len(hits)
+
+
+def bench_index(srcs: list[str]):
+    import astindex
+
+    trees = [ast.parse(i) for i in srcs]
+    size = sum(len(i.encode()) for i in srcs)
+    dt, _ = timed(lambda: [sum(1 for _ in ast.walk(t)) for t in trees], n=3)
+    report("ast.walk", size, dt)
+    dt, ixs = timed(lambda: [astindex.Index(t) for t in trees], n=3)
+    report("Index", size, dt)
+    dt, old = timed(lambda: [[n for n in ast.walk(t) if isinstance(n, ast.Call)] for t in trees], n=3)
+    report("walk for Call", size, dt)
+    dt, new = timed(lambda: [i.find("Call") for i in ixs], n=3)
+    report("Index.find Call", size, dt)
+    assert [len(i) for i in old] == [len(i) for i in new]
+    dt, _ = timed(lambda: [[i.parent(n) for n in c] for i, c in zip(ixs, new)], n=3)
+    report("parents of Calls", size, dt)
+    dt, _ = timed(lambda: [i.lines(100, 120) for i in ixs], n=3)
+    report("Index.lines 100-120", size, dt)
+
+
+# MacroExecutor before the site index: a NodeTransformer over every node
+def old_executor():
+    import macro
+
+    class OldMacroExecutor(ast.NodeTransformer):
+        def visit_Call(self, arg):
+            self.generic_visit(arg)
+            match arg:
+                case ast.Call(func=ast.Name(id=name)):
+                    if name not in macro.macros["expr"] or name in macro.macros["stmt"]:
+                        return arg
+                    kws = {(i.arg or "star"): i.value for i in arg.keywords}
+                    return macro.macros["expr"][name](*arg.args, **kws)
+                case o:
+                    return o
+
+        def visit_Expr(self, node):
+            self.generic_visit(node)
+            match node:
+                case ast.Expr(value=ast.Call(func=ast.Name(id=name))):
+                    if name not in macro.macros["stmt"]:
+                        return node
+                    kws = {(i.arg or "star"): i.value for i in node.value.keywords}
+                    return macro.macros["stmt"][name](*node.value.args, **kws)
+                case o:
+                    return o
+
+    return OldMacroExecutor()
+
+
+# import_with_macros' pipeline before the fast paths, kept for comparison
+def old_compile_with_macros(code: str, filename: str):
+    import io, macro, tokenize
+
+    tok = list(tokenize.tokenize(io.BytesIO(code.encode("utf8")).readline))
+    nodes = ast.parse(tokenize.untokenize(tok), "exec")
+    nodes = old_executor().visit(nodes)
+    ast.fix_missing_locations(nodes)
+    return compile(nodes, filename, "exec")
+
+
+def bench_macro(srcs: list[str]):
+    # one big module without macros, compiled every way an import might
+    import importlib, macro
+
+    # (each file under an if that's false at run time, so importing only
+    # pays for the compiling and loading)
+    code = "".join(
+        'if __name__ == "never":\n' + "".join("    " + j + "\n" for j in i.splitlines())
+        for i in srcs
+        if "from __future__" not in i
+    )
+    size = len(code.encode())
+    dt, _ = timed(lambda: compile(code, "x", "exec"), n=3)
+    report("compile", size, dt)
+    dt, _ = timed(lambda: old_compile_with_macros(code, "x"), n=3)
+    report("with macros (old)", size, dt)
+    dt, _ = timed(lambda: macro.compile_with_macros(code, "x"), n=3)
+    report("with macros", size, dt)
+    with tempfile.TemporaryDirectory() as d:
+        with open(os.path.join(d, "_big.mpy"), "w") as fo:
+            fo.write(code)
+        sys.path.insert(0, d)
+        macro.install()
+        try:
+
+            def imp():
+                sys.modules.pop("_big", None)
+                return importlib.import_module("_big")
+
+            dt, _ = timed(imp)
+            report("import .mpy (cold)", size, dt)
+            dt, _ = timed(imp, n=3)
+            report("import .mpy (cached)", size, dt)
+        finally:
+            macro.uninstall()
+            sys.path.remove(d)
+            sys.modules.pop("_big", None)
+
+
+def with_sites(srcs: list[str], line: str) -> str:
+    # the corpus as one module, with line (formatted with a counter as i)
+    # after every top-level statement
+    parts = []
+    n = 0
+    for src in srcs:
+        if "from __future__" in src:
+            continue
+        lines = src.splitlines(keepends=True)
+        body = ast.parse(src).body[1:]
+        cut = [min([i.lineno] + [d.lineno for d in getattr(i, "decorator_list", ())]) - 1 for i in body]
+        for a, e in zip([0] + cut, cut + [len(lines)]):
+            parts += lines[a:e]
+            parts.append(line.format(i=n) + "\n")
+            n += 1
+    return "".join(parts)
+
+
+# the token stage before the streaming rewriter, kept for comparison
+def old_expand_tokens(code: str, tab: dict) -> str:
+    import io, tokenize
+
+    tok = list(tokenize.tokenize(io.BytesIO(code.encode("utf8")).readline))[::-1]
+    nl = []
+    while tok:
+        cur = tok.pop()
+        if cur.type == tokenize.NAME and cur.string in tab:
+            ch = tok.pop()
+            if ch.type == tokenize.OP and ch.string == "(":
+                qs = 1
+                ls = []
+                while qs:
+                    c = tok.pop()
+                    if c.type == tokenize.OP and c.string == ")":
+                        qs -= 1
+                    if c.type == tokenize.OP and c.string == "(":
+                        qs += 1
+                    if qs:
+                        ls.append(c)
+                nl += [*tab[cur.string](*ls)]
+            else:
+                nl += [cur, ch]
+        else:
+            nl.append(cur)
+    return tokenize.untokenize(nl).decode("utf8")
+
+
+def bench_tokmacro(srcs: list[str]):
+    # the corpus with a nested token macro call after every top-level statement
+    import macro, tokenize
+
+    def sq(*a):
+        return [(tokenize.OP, "("), *a, (tokenize.OP, ")"), (tokenize.OP, "**"), (tokenize.NUMBER, "2")]
+
+    saved = dict(macro.macros["tok"])
+    macro.macros["tok"]["mac_sq"] = sq
+    try:
+        code = with_sites(srcs, "_m{i} = mac_sq(1 + mac_sq({i}))")
+        sites = code.count("mac_sq") // 2
+        size = len(code.encode())
+        print(f"{sites} sites")
+        dt, old = timed(lambda: old_expand_tokens(code, {"mac_sq": sq}), n=3)
+        report("expand_tokens (old)", size, dt)
+        dt, new = timed(lambda: macro.expand_tokens(code), n=3)
+        report("expand_tokens", size, dt)
+        dt, _ = timed(lambda: sum(1 for _ in tokenize.generate_tokens(io.StringIO(code).readline)), n=3)
+        report("tokenize alone", size, dt)
+        # the old one didn't expand calls in arguments, so only compare how
+        # much of the file survives: everything outside the calls
+        strip = lambda x: "".join(x.split())
+        pows = ast.dump(ast.parse(code)).count("Pow")
+        assert ast.dump(ast.parse(new)).count("Pow") == pows + 2 * sites
+        assert len(strip(new)) < len(strip(code)) and "mac_sq" not in new
+        assert "mac_sq" in old  # the inner calls
+    finally:
+        macro.macros["tok"] = saved
+
+
+def bench_expand(srcs: list[str]):
+    # the corpus with an expression and a statement macro after every
+    # top-level statement, expanded on a fresh tree each time
+    import macro
+
+    def sq(a):
+        return ast.BinOp(a, ast.Pow(), ast.Constant(2))
+
+    def note(a):
+        return ast.Assign([ast.Name("_note", ast.Store())], a, lineno=0)
+
+    saved = {k: dict(v) for k, v in macro.macros.items()}
+    macro.macros["expr"]["mac_sq"] = sq
+    macro.macros["stmt"]["mac_note"] = note
+    try:
+        code = with_sites(srcs, "mac_note(mac_sq(1 + mac_sq({i})))")
+        size = len(code.encode())
+        print(f"{code.count('mac_note')} statement sites")
+
+        def run(ex):
+            tree = ast.parse(code)
+            t = time.perf_counter()
+            ex.visit(tree)
+            return time.perf_counter() - t, tree
+
+        old, new = run(old_executor()), run(macro.MacroExecutor())
+        assert ast.dump(old[1]) == ast.dump(new[1])
+        report("expand (old)", size, min(old[0], run(old_executor())[0]))
+        report("expand", size, min(new[0], run(macro.MacroExecutor())[0]))
+        lines = macro.site_lines(code)
+        report("expand (site lines)", size, min(run(macro.MacroExecutor(lines))[0] for _ in range(2)))
+        # same tree, more sites: a macro expanding into three more
+        macro.macros["expr"]["mac_sq3"] = lambda a: ast.parse("mac_sq(mac_sq(mac_sq(0)))", mode="eval").body
+        code = code.replace("mac_sq(1", "mac_sq3(1")
+        lines = macro.site_lines(code)
+        report("expand (nested)", size, min(run(macro.MacroExecutor(lines))[0] for _ in range(2)))
+    finally:
+        macro.macros.update(saved)
+
+
+def bench_explain(srcs: list[str]):
+    import explain
+
+    size = sum(len(i.encode()) for i in srcs)
+    cos = [compile(i, "x", "exec") for i in srcs]
+    dt, n = timed(lambda: sum(1 for co in cos for _ in explain.explain(co)))
+    print(f"{n} instructions")
+    report("explain", size, dt)
+    dt, _ = timed(lambda: [explain.to_json(r) for co in cos for r in explain.explain(co)])
+    report("explain + to_json", size, dt)
+    dt, _ = timed(lambda: [json.dumps(r._asdict()) for co in cos for r in explain.explain(co)])
+    report("explain + json.dumps", size, dt)
+    with tempfile.TemporaryDirectory() as d:
+        for i, src in enumerate(srcs):
+            with open(os.path.join(d, f"m{i}.py"), "w") as fo:
+                fo.write(src)
+        files = asttransfer.find_files([d])
+        for j in sorted({1, os.cpu_count() or 1}):
+            dt, _ = timed(lambda: sum(len(i[1]) for i in explain.explain_files(files, jobs=j)))
+            report(f"explain_files -j{j}", size, dt)
+
+
+def bench_profile(srcs: list[str]):
+    # overhead of counting instructions, on tokenizing a few modules
+    import explain, tokenize
+
+    size = sum(len(i.encode()) for i in srcs[:10])
+    work = lambda: [list(tokenize.generate_tokens(io.StringIO(i).readline)) for i in srcs[:10]]
+    dt, _ = timed(work, n=3)
+    report("plain", size, dt)
+    p = explain.Profile()
+    with p:
+        dt, _ = timed(work)
+    report("profiled", size, dt)
+    print(f"{sum(p.by_code().values())} instructions, {'monitoring' if p._mon else 'settrace'}")
+
+
+def bench_cfg(srcs: list[str]):
+    import explain
+
+    size = sum(len(i.encode()) for i in srcs)
+    cos = [c for i in srcs for c in explain.code_objects(compile(i, "x", "exec"))]
+    dt, gs = timed(lambda: [explain.CFG(c) for c in cos])
+    print(f"{len(cos)} code objects, {sum(len(g.blocks) for g in gs)} blocks, {sum(len(g.loops) for g in gs)} loops")
+    report("CFG", size, dt)
+    explain._cfgs.clear()
+    dt, n = timed(lambda: sum(1 for c in cos for _ in explain.smells(c, nested=False)))
+    report(f"smells ({n})", size, dt)
+    dt, _ = timed(lambda: sum(1 for c in cos for _ in explain.smells(c, nested=False)))
+    report("smells (cached CFGs)", size, dt)
+
+
+def bench_asdl(srcs: list[str]):
+    import asdl
+
+    schema = os.path.join(here, "Python.asdl")
+    with open(schema) as fi:
+        buf = fi.read()
+    size = len(buf.encode())
+    dt, _ = timed(lambda: asdl.ASDLParser().parse(buf), n=50)
+    report("ASDLParser.parse", size, dt)
+    dt, _ = timed(lambda: list(asdl.tokenize_asdl(buf)), n=50)
+    report("tokenize_asdl", size, dt)
+    asdl.parse(schema)
+    dt, _ = timed(lambda: asdl.parse(schema), n=50)
+    report("parse (cached)", size, dt)
+
+
+benches = {
+    "parse": bench_parse,
+    "serialize": bench_serialize,
+    "binary": bench_binary,
+    "share": bench_share,
+    "codec": bench_codec,
+    "const": bench_const,
+    "stream": bench_stream,
+    "diff": bench_diff,
+    "nodes": bench_nodes,
+    "asdl": bench_asdl,
+    "columnar": bench_columnar,
+    "index": bench_index,
+    "macro": bench_macro,
+    "tokmacro": bench_tokmacro,
+    "expand": bench_expand,
+    "explain": bench_explain,
+    "profile": bench_profile,
+    "cfg": bench_cfg,
+}
+
+if __name__ == "__main__":
+    what = sys.argv[1] if len(sys.argv) > 1 else "all"
+    srcs = corpus(sys.argv[2:])
+    for i in benches if what == "all" else what.split(","):
+        print(f"-- {i}")
+        benches[i](srcs)
@@ -0,0 +1,262 @@
+# columnar storage of python asts, laid out from the ASDL schema: a table per
+# constructor (and product) with one array per field, nodes referring to each
+# other by integer ids, identifiers and strings going through one shared
+# string table. Queries scan whole columns (with numpy when it's installed)
+# instead of walking trees.
+# usage: st = Store.from_ast(ast.parse(src))
+#        st.where("Call", "func", st.where("Name", "id", "print"))
+
+import ast, asdl
+import array, collections, itertools
+import typing
+import asttransfer
+import s
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# a node id is (table code << 32) | row, so both come out of an id without a
+# lookup, for whole columns at once too; -1 is a missing node
+_shift = 32
+_mask = (1 << _shift) - 1
+_none = -(1 << 63)  # a missing int (ints are stored as is)
+
+# how a field is stored, by the field's type
+node, enum, text, num, const = range(5)
+_codes = {node: "q", enum: "b", text: "i", num: "q", const: "i"}
+
+
+class Table:
+    # the nodes of one constructor, one column per field and attribute.
+    # Sequence fields have their items in one column and the end of each
+    # node's items in another (ends), like offsets into a flat list
+    def __init__(self, name: str, code: int, fields: list[asdl.Field], how: list[int]):
+        self.name = name
+        self.code = code
+        self.fields = fields
+        self.how = how
+        self.cls = getattr(ast, name, None)
+        self.n = 0
+        self.index = {str(f.name): i for i, f in enumerate(fields)}
+        self.cols = {str(f.name): array.array(_codes[h]) for f, h in zip(fields, how)}
+        self.ends = {str(f.name): array.array("q") for f in fields if f.seq}
+
+    def __len__(self):
+        return self.n
+
+    def nbytes(self) -> int:
+        cols = itertools.chain(self.cols.values(), self.ends.values())
+        return sum(len(i) * i.itemsize for i in cols)
+
+
+class Store:
+    # a whole tree in columns, build it with from_ast or from_sexpr
+    def __init__(self, schema: asdl.Module | None = None):
+        if schema is None:
+            schema = asttransfer.astast
+        self.schema = schema
+        self.tables: dict[str, Table] = {}
+        self.enums: dict[str, list[str]] = {}
+        self.strings: list[str] = []
+        self.consts: list[typing.Any] = []
+        self.root = -1
+        self._sids: dict[str, int] = {}
+        enums = asttransfer.enum_kinds(schema)
+        for k, tp in schema.types.items():
+            if k in enums:
+                self.enums[k] = [str(c.name) for c in tp.types]
+        ctors = []
+        for k, tp in schema.types.items():
+            if isinstance(tp, asdl.Product):
+                ctors.append((k, tp.fields + tp.attributes))
+            elif k not in self.enums:
+                ctors += [(str(c.name), c.fields + tp.attributes) for c in tp.types]
+        for code, (nm, fs) in enumerate(ctors):
+            self.tables[nm] = Table(nm, code, fs, [self._how(f) for f in fs])
+        self._by_code = list(self.tables.values())
+
+    def _how(self, f: asdl.Field) -> int:
+        if f.type in self.enums:
+            return enum
+        if f.type in ("identifier", "string"):
+            return text
+        if f.type == "int":
+            return num
+        if f.type == "constant":
+            return const
+        return node
+
+    def sid(self, x: str) -> int:
+        # the index of x in the string table, adding it if needed
+        i = self._sids.get(x)
+        if i is None:
+            i = self._sids[x] = len(self.strings)
+            self.strings.append(x)
+        return i
+
+    def nbytes(self) -> int:
+        # the columns only, not the string and constant tables
+        return sum(i.nbytes() for i in self.tables.values())
+
+    # conversion
+
+    @classmethod
+    def from_ast(cls, tree: ast.AST, schema: asdl.Module | None = None) -> "Store":
+        st = cls(schema)
+        tabs = {t.cls: t for t in st.tables.values() if t.cls is not None}
+        enums = {}
+        for k, names in st.enums.items():
+            enums.update((getattr(ast, n), i) for i, n in enumerate(names) if hasattr(ast, n))
+        counts = [0] * len(st._by_code)
+        consts = st.consts
+        sid = st.sid
+
+        def reserve(n: ast.AST | None) -> int:
+            if n is None:
+                return -1
+            t = tabs.get(type(n))
+            if t is None:
+                raise TypeError(f"can't store {type(n).__name__!r}")
+            i = counts[t.code]
+            counts[t.code] += 1
+            q.append(n)
+            return t.code << _shift | i
+
+        def value(h: int, x: typing.Any) -> int:
+            if h == node:
+                return reserve(x)
+            if h == enum:
+                return enums[type(x)]
+            if x is None:
+                return _none if h == num else -1
+            if h == text:
+                return sid(x)
+            if h == num:
+                return x
+            consts.append(x)
+            return len(consts) - 1
+
+        # rows are written in the order their ids were handed out, a queue
+        # keeps it that way without recursing
+        q: collections.deque = collections.deque()
+        st.root = reserve(tree)
+        while q:
+            n = q.popleft()
+            t = tabs[type(n)]
+            for f, h in zip(t.fields, t.how):
+                x = getattr(n, str(f.name), None)
+                col = t.cols[str(f.name)]
+                if f.seq:
+                    col.extend([value(h, i) for i in x or ()])
+                    t.ends[str(f.name)].append(len(col))
+                else:
+                    col.append(value(h, x))
+            t.n += 1
+        return st
+
+    def to_ast(self) -> ast.AST:
+        # every node is made first, then the fields are filled in table by table
+        objs = [[t.cls() for _ in range(t.n)] if t.cls else [] for t in self._by_code]
+        enums = {k: [getattr(ast, n)() if hasattr(ast, n) else None for n in v] for k, v in self.enums.items()}
+        strings, consts = self.strings, self.consts
+
+        def get(f: asdl.Field, h: int, x: int) -> typing.Any:
+            if h == node:
+                return objs[x >> _shift][x & _mask] if x >= 0 else None
+            if h == enum:
+                return enums[f.type][x]
+            if h == num:
+                return None if x == _none else x
+            if x < 0:
+                return None
+            return strings[x] if h == text else consts[x]
+
+        for t, row in zip(self._by_code, objs):
+            for f, h in zip(t.fields, t.how):
+                nm = str(f.name)
+                col = t.cols[nm]
+                if f.seq:
+                    start = 0
+                    for o, end in zip(row, t.ends[nm]):
+                        setattr(o, nm, [get(f, h, i) for i in col[start:end]])
+                        start = end
+                else:
+                    for o, i in zip(row, col):
+                        setattr(o, nm, get(f, h, i))
+        return objs[self.root >> _shift][self.root & _mask]
+
+    @classmethod
+    def from_sexpr(cls, form: s.se_type, kind: str = "mod", schema: asdl.Module | None = None) -> "Store":
+        # form as made by asttransfer.dump_node
+        return cls.from_ast(asttransfer.load_node(form, kind), schema)
+
+    def to_sexpr(self, kind: str = "mod") -> s.se_type:
+        return asttransfer.dump_node(self.to_ast(), kind)
+
+    # queries
+
+    def kind(self, i: int) -> str:
+        return self._by_code[i >> _shift].name
+
+    def ids(self, name: str) -> typing.Sequence[int]:
+        # the ids of all nodes of a constructor
+        t = self.tables[name]
+        if np is not None:
+            return np.arange(t.n, dtype=np.int64) + (t.code << _shift)
+        return array.array("q", range(t.code << _shift, (t.code << _shift) + t.n))
+
+    def get(self, i: int, field: str) -> typing.Any:
+        # one field of one node: ids for nodes, constructor names for enums
+        t = self._by_code[i >> _shift]
+        row = i & _mask
+        k = t.index[field]
+        col = t.cols[field]
+        if field in t.ends:
+            ends = t.ends[field]
+            xs = col[ends[row - 1] if row else 0 : ends[row]]
+            return [self._decode(t.fields[k], t.how[k], x) for x in xs]
+        return self._decode(t.fields[k], t.how[k], col[row])
+
+    def _decode(self, f: asdl.Field, h: int, x: int) -> typing.Any:
+        if h == enum:
+            return self.enums[f.type][x]
+        if h == num:
+            return None if x == _none else x
+        if h == node:
+            return x if x >= 0 else None
+        if x < 0:
+            return None
+        return self.strings[x] if h == text else self.consts[x]
+
+    def where(self, name: str, field: str, value: typing.Any) -> typing.Sequence[int]:
+        # ids of the name nodes whose field is value. value is a string for
+        # identifiers, strings and enums (by constructor name), an int for
+        # ints and a sequence of ids for nodes (the field being any of them),
+        # or None for a missing value. Not for sequence fields or constants
+        t = self.tables[name]
+        if field in t.ends:
+            raise TypeError(f"{name}.{field} is a sequence")
+        k = t.index[field]
+        h = t.how[k]
+        if h == const:
+            raise TypeError(f"{name}.{field} holds constants")
+        col = t.cols[field]
+        many = h == node
+        if value is None:
+            value = _none if h == num else -1
+            many = False
+        elif h == enum:
+            value = self.enums[t.fields[k].type].index(value)
+        elif h == text:
+            value = self._sids.get(value, -2)
+        base = t.code << _shift
+        if np is not None:
+            if not t.n:
+                return np.zeros(0, dtype=np.int64)
+            c = np.frombuffer(col, dtype=col.typecode)
+            mask = np.isin(c, np.asarray(value, dtype=np.int64)) if many else c == value
+            return np.flatnonzero(mask).astype(np.int64) + base
+        test = set(value).__contains__ if many else lambda x: x == value
+        return array.array("q", [base + i for i in itertools.compress(range(t.n), map(test, col))])
@@ -2,7 +2,9 @@
 # TODO: explain AST too
 
 import ast, dis
+import bisect, collections, json, os, sys, threading, warnings, weakref
 import typing, types
+import asttransfer
 
 ops: dict[str, str] = {
     "RESUME": "starts execution",
@@ -24,38 +26,578 @@ ops: dict[str, str] = {
 }
 
 
-def explain_bytecode(code: str):
-    co = compile(code, "<dis>", "exec")
-    dis.dis(co)
-    inst = list(dis.get_instructions(co))
-    for i in inst:
-        print(i.opname, i.arg if i.arg is not None else "")
-        print("-", ops[i.opname] if i.opname in ops else "<unknown purpose>")
-        if i.is_jump_target:
-            print(f"- *{i.offset:x}")
-        if i.opcode < dis.HAVE_ARGUMENT:
+class Record(typing.NamedTuple):
+    # one instruction, explained
+    code: str  # qualified name of the code object it's in
+    offset: int
+    line: int | None
+    opname: str
+    arg: int | None
+    argrepr: str
+    purpose: str | None  # from ops
+    target: int | None  # where a jump goes
+    jump_target: bool  # whether something jumps here
+
+
+_jumps = frozenset(dis.hasjrel + dis.hasjabs)
+
+
+def code_objects(co: types.CodeType, /) -> typing.Iterator[types.CodeType]:
+    # co and every code object nested in it (functions, classes,
+    # comprehensions...), in source order
+    stack = [co]
+    while stack:
+        co = stack.pop()
+        yield co
+        stack += reversed([i for i in co.co_consts if isinstance(i, types.CodeType)])
+
+
+def _name(co: types.CodeType) -> str:
+    return co.co_qualname if hasattr(co, "co_qualname") else co.co_name
+
+
+def explain(co: types.CodeType, /, *, nested: bool = True) -> typing.Iterator[Record]:
+    # the instructions of co, then of the code nested in it (if nested)
+    for co in code_objects(co) if nested else (co,):
+        name = _name(co)
+        line = None
+        for i in dis.get_instructions(co):
+            # positions are 3.11+, before that only a line's first instruction has it
+            p = getattr(i, "positions", None)
+            x = p.lineno if p is not None else i.starts_line
+            if x is not None:
+                line = x
+            yield Record(
+                name,
+                i.offset,
+                line,
+                i.opname,
+                i.arg,
+                i.argrepr,
+                ops.get(i.opname),
+                i.argval if i.opcode in _jumps else None,
+                i.is_jump_target,
+            )
+
+
+def explain_source(code: str, filename: str = "<dis>") -> typing.Iterator[Record]:
+    return explain(compile(code, filename, "exec"))
+
+
+def explain_bytecode(
+    code: str | types.CodeType, counts: dict[types.CodeType, list[int]] | None = None
+):
+    # prints the explanation; with counts (see Profile), each instruction
+    # gets how often it ran, leaving out the code that never did
+    co = compile(code, "<dis>", "exec") if isinstance(code, str) else code
+    if counts is None:
+        dis.dis(co)
+    for c in code_objects(co):
+        cs = counts.get(c) if counts is not None else None
+        if counts is not None and cs is None:
             continue
+        if cs is None:
+            print(f"-- {_name(c)}")
         else:
-            assert i.arg is not None
-        if i.opname == "LOAD_ATTR":
-            pass
-        elif i.opcode in dis.hasjrel:
-            assert i.arg
-            if i.opname in ("JUMP_BACKWARD", "JUMP_BACKWARDS_NO_INTERRUPT"):
-                tar = i.offset - 2 * (i.arg - 1)
-            else:
-                tar = i.offset + 2 * (i.arg + 1)
-            print(f"- jump target: *{tar:x}")
-        elif i.opcode in dis.hasname:
-            print(i.arg, co.co_names, i.opname)
-            print(f"- name: {co.co_names[i.arg]!r}")
-        elif i.opcode in dis.hascompare:
-            print(f"- comparison: {dis.cmp_op[i.arg]!r}")
+            print(f"-- {_name(c)} ({c.co_filename}:{c.co_firstlineno}), {sum(cs)} instructions run")
+        loops = cfg(c).loops
+        bad = {i.offset: i for i in smells(c, nested=False)}
+        for r in explain(c, nested=False):
+            n = f"{cs[r.offset >> 1]:>10} " if cs is not None else ""
+            print(n + r.opname, r.arg if r.arg is not None else "")
+            print("-", r.purpose or "<unknown purpose>")
+            if r.jump_target:
+                print(f"- *{r.offset:x}")
+            if r.offset in loops:
+                print(f"- starts a loop of {len(loops[r.offset])} blocks")
+            if r.offset in bad:
+                s = bad[r.offset]
+                print(f"- smell: {s.kind} {s.name} in the loop at {s.loop}, {s.count} place(s)")
+            if r.target is not None:
+                print(f"- jump target: *{r.target:x}")
+            elif r.argrepr:
+                print(f"- {r.argrepr}")
+
+
+class Profile:
+    # counts the instructions run, per code object and offset. Uses
+    # sys.monitoring where there is one (3.12+), or else opcode tracing with
+    # sys.settrace (much slower, and only for threads started after start()).
+    # Each thread counts into its own dicts, merged into counts by stop().
+    # usage: with Profile() as p: ...; explain_bytecode(co, p.counts)
+    def __init__(self):
+        # per code object, a count per instruction (by offset // 2)
+        self.counts: dict[types.CodeType, list[int]] = {}
+        self._threads: list[dict[types.CodeType, list[int]]] = []
+        self._mon = hasattr(sys, "monitoring")
+        self._saved: typing.Any = None
+
+    def _new(self) -> dict[types.CodeType, list[int]]:
+        counts: dict[types.CodeType, list[int]] = {}
+        self._threads.append(counts)
+        return counts
+
+    def _monitor(self) -> typing.Callable[[types.CodeType, int], None]:
+        loc = threading.local()
+
+        def count(code: types.CodeType, offset: int):
+            try:
+                counts = loc.counts
+            except AttributeError:
+                counts = loc.counts = self._new()
+            c = counts.get(code)
+            if c is None:
+                c = counts[code] = [0] * (len(code.co_code) >> 1)
+            c[offset >> 1] += 1
+
+        return count
+
+    def _tracer(self) -> typing.Callable:
+        counts = self._new()
+
+        def trace(frame: types.FrameType, event: str, arg: typing.Any):
+            if event == "opcode":
+                code = frame.f_code
+                c = counts.get(code)
+                if c is None:
+                    c = counts[code] = [0] * (len(code.co_code) >> 1)
+                c[frame.f_lasti >> 1] += 1
+            elif event == "call":
+                frame.f_trace_opcodes = True
+            return trace
+
+        return trace
+
+    def _boot(self, frame: types.FrameType, event: str, arg: typing.Any):
+        # threading.settrace's hook: every new thread gets its own tracer
+        trace = self._tracer()
+        sys.settrace(trace)
+        return trace(frame, event, arg)
+
+    def start(self):
+        if self._mon:
+            mon = sys.monitoring
+            mon.use_tool_id(mon.PROFILER_ID, "explain")
+            mon.register_callback(mon.PROFILER_ID, mon.events.INSTRUCTION, self._monitor())
+            mon.set_events(mon.PROFILER_ID, mon.events.INSTRUCTION)
+            return
+        trace = self._tracer()
+        self._saved = sys.gettrace()
+        threading.settrace(self._boot)
+        sys.settrace(trace)
+        # the frames already running count from here on too
+        f = sys._getframe(1)
+        while f is not None:
+            f.f_trace = trace
+            f.f_trace_opcodes = True
+            f = f.f_back
+
+    def stop(self):
+        if self._mon:
+            mon = sys.monitoring
+            mon.set_events(mon.PROFILER_ID, 0)
+            mon.register_callback(mon.PROFILER_ID, mon.events.INSTRUCTION, None)
+            mon.free_tool_id(mon.PROFILER_ID)
+        else:
+            sys.settrace(self._saved)
+            threading.settrace(None)  # type: ignore[arg-type]
+            f = sys._getframe(1)
+            while f is not None:
+                f.f_trace_opcodes = False
+                f = f.f_back
+        for counts in self._threads:
+            for code, c in counts.items():
+                mine = self.counts.get(code)
+                if mine is None:
+                    self.counts[code] = c
+                else:
+                    self.counts[code] = [a + b for a, b in zip(mine, c)]
+        self._threads = []
+
+    def __enter__(self) -> "Profile":
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def by_code(self) -> dict[types.CodeType, int]:
+        # instructions run per code object, most first
+        ret = {co: sum(c) for co, c in self.counts.items()}
+        return dict(sorted(ret.items(), key=lambda i: -i[1]))
+
+    def by_opcode(self) -> collections.Counter[str]:
+        ret: collections.Counter[str] = collections.Counter()
+        for co, c in self.counts.items():
+            for i in dis.get_instructions(co):
+                if c[i.offset >> 1]:
+                    ret[i.opname] += c[i.offset >> 1]
+        return ret
+
+
+# jumps that always jump, and instructions that leave the code object (or
+# go to an exception handler); the next instruction starts a block after both
+_always = frozenset(
+    {"JUMP_FORWARD", "JUMP_BACKWARD", "JUMP_BACKWARD_NO_INTERRUPT", "JUMP_ABSOLUTE", "JUMP", "JUMP_NO_INTERRUPT"}
+)
+_exits = frozenset({"RETURN_VALUE", "RETURN_CONST", "RAISE_VARARGS", "RERAISE"})
+# opcodes that can jump backwards, so code without them has no loops
+_back = frozenset(v for k, v in dis.opmap.items() if "BACKWARD" in k or k == "JUMP_ABSOLUTE")
+
+
+class Block:
+    # a basic block: instructions that run one after the other from the top
+    def __init__(self, start: int):
+        self.start = start
+        self.end = start  # offset of the next block
+        self.instrs: list[dis.Instruction] = []
+        self.succs: list[int] = []  # starts of the blocks it can go to
+        self.preds: list[int] = []
+        self.handlers: list[int] = []  # the exception handlers among succs
+        self.depth: int | None = None  # stack depth on entry, None if unreachable
+        self.peak: int | None = None  # deepest the stack gets in it
+        self.loop = False  # whether it's a loop header
+        self.exc = False  # whether only exceptions get here
+
+    def __repr__(self):
+        return f"<Block *{self.start:x}-*{self.end:x} -> {', '.join(f'*{i:x}' for i in self.succs)}>"
+
+
+class CFG:
+    # the control-flow graph of one code object (not the nested ones). Get
+    # these through cfg(), which keeps them as long as the code object
+    def __init__(self, co: types.CodeType):
+        self.name = _name(co)
+        self.blocks: dict[int, Block] = {}
+        # loop header -> the starts of the blocks in the loop, header included
+        self.loops: dict[int, set[int]] = {}
+        ins = list(dis.get_instructions(co))
+        if not ins:
+            return
+        exc = getattr(dis.Bytecode(co), "exception_entries", ())
+        offsets = {i.offset for i in ins}
+        heads = {ins[0].offset}
+        for e in exc:
+            heads |= {e.start, e.end, e.target}
+        for i, nxt in zip(ins, ins[1:] + [None]):
+            if i.opcode in _jumps:
+                heads.add(i.argval)
+            if nxt is not None and (i.opcode in _jumps or i.opname in _exits):
+                heads.add(nxt.offset)
+        heads &= offsets
+        b = None
+        for i in ins:
+            if i.offset in heads:
+                b = self.blocks[i.offset] = Block(i.offset)
+            assert b is not None
+            b.instrs.append(i)
+        starts = list(self.blocks)
+        end = ins[-1].offset + 2
+        for s, e in zip(starts, starts[1:] + [end]):
+            self.blocks[s].end = e
+        # normal edges, with whether they're a jump (for stack_effect)
+        out: dict[int, list[tuple[int, bool]]] = {}
+        for s, nxt in zip(starts, starts[1:] + [None]):
+            b = self.blocks[s]
+            last = b.instrs[-1]
+            es = []
+            if last.opcode in _jumps:
+                es.append((last.argval, True))
+            if last.opname not in _always and last.opname not in _exits and nxt is not None:
+                es.append((nxt, False))
+            out[s] = es
+            b.succs = [i for i, _ in es]
+        handlers = {}
+        for e in exc:
+            handlers[e.target] = e.depth + 1 + int(e.lasti)
+            # the range's ends start blocks, so it's whole blocks
+            for s in starts[bisect.bisect_left(starts, e.start) : bisect.bisect_left(starts, e.end)]:
+                self.blocks[s].handlers.append(e.target)
+                self.blocks[s].succs.append(e.target)
+        for s in starts:
+            for t in self.blocks[s].succs:
+                self.blocks[t].preds.append(s)
+        seen = {starts[0]}
+        todo = [starts[0]]
+        while todo:
+            for t, _ in out[todo.pop()]:
+                if t not in seen:
+                    seen.add(t)
+                    todo.append(t)
+        for s in starts:
+            self.blocks[s].exc = s not in seen
+        self._depths(out, handlers)
+        self._loops(starts[0])
+
+    def _depths(self, out: dict[int, list[tuple[int, bool]]], handlers: dict[int, int]):
+        work = [(next(iter(self.blocks)), 0), *handlers.items()]
+        while work:
+            s, d = work.pop()
+            b = self.blocks[s]
+            if b.depth is not None:
+                continue
+            b.depth = peak = d
+            for i in b.instrs[:-1]:
+                d += _effect(i, False)
+                peak = max(peak, d)
+            last = b.instrs[-1]
+            for t, jump in out[s]:
+                work.append((t, d + _effect(last, jump)))
+            b.peak = max(peak, d + _effect(last, False), d + _effect(last, True))
+
+    def _loops(self, entry: int):
+        # back edges are the ones to a block still on the depth-first stack,
+        # a loop is what reaches the edge's source without passing its target
+        on, done = set(), set()
+        stack = [(entry, iter(self.blocks[entry].succs))]
+        on.add(entry)
+        while stack:
+            s, it = stack[-1]
+            t = next(it, None)
+            if t is None:
+                stack.pop()
+                on.discard(s)
+                done.add(s)
+            elif t in on:
+                body = self.loops.setdefault(t, {t})
+                todo = [s]
+                while todo:
+                    x = todo.pop()
+                    if x not in body:
+                        body.add(x)
+                        todo += self.blocks[x].preds
+                self.blocks[t].loop = True
+            elif t not in done:
+                on.add(t)
+                stack.append((t, iter(self.blocks[t].succs)))
+
+    def block(self, offset: int) -> Block:
+        # the block holding the instruction at offset
+        starts = list(self.blocks)
+        return self.blocks[starts[bisect.bisect_right(starts, offset) - 1]]
+
+
+def _effect(i: dis.Instruction, jump: bool) -> int:
+    return dis.stack_effect(i.opcode, i.arg if i.opcode >= dis.HAVE_ARGUMENT else None, jump=jump)
+
+
+_cfgs: "weakref.WeakKeyDictionary[types.CodeType, CFG]" = weakref.WeakKeyDictionary()
+
+
+def cfg(co: types.CodeType) -> CFG:
+    ret = _cfgs.get(co)
+    if ret is None:
+        ret = _cfgs[co] = CFG(co)
+    return ret
+
+
+class Smell(typing.NamedTuple):
+    # something slow done on every iteration of a loop
+    code: str
+    line: int | None  # of the first place it's done
+    offset: int
+    kind: str  # "global" or "attribute"
+    name: str  # the global, or base.attribute
+    count: int  # places in the loop doing it
+    loop: int | None  # line of the loop header
+
+
+# instructions loading the base of an attribute load we can name, and the
+# ones changing a name. 3.13's superinstructions carry a tuple of names:
+# LOAD_FAST_LOAD_FAST pushes both (the base is the second),
+# STORE_FAST_LOAD_FAST stores the first and pushes the second
+_bases = frozenset(
+    {
+        "LOAD_FAST",
+        "LOAD_FAST_CHECK",
+        "LOAD_GLOBAL",
+        "LOAD_NAME",
+        "LOAD_DEREF",
+        "LOAD_FAST_LOAD_FAST",
+        "STORE_FAST_LOAD_FAST",
+    }
+)
+_stores = frozenset(
+    {
+        "STORE_FAST",
+        "STORE_NAME",
+        "STORE_GLOBAL",
+        "STORE_DEREF",
+        "DELETE_FAST",
+        "DELETE_NAME",
+        "STORE_FAST_STORE_FAST",
+        "STORE_FAST_LOAD_FAST",
+        "STORE_FAST_MAYBE_NULL",
+    }
+)
+
+
+def _stored(i: dis.Instruction) -> tuple[str, ...]:
+    if i.opname == "STORE_FAST_LOAD_FAST":
+        return i.argval[:1]
+    return i.argval if isinstance(i.argval, tuple) else (i.argval,)
+
+
+def _base(i: dis.Instruction) -> str:
+    return i.argval[-1] if isinstance(i.argval, tuple) else i.argval
+
+
+def _line(i: dis.Instruction, starts: list[tuple[int, int]]) -> int | None:
+    # positions are 3.11+, before that the line is the last one starting at
+    # or before the instruction (starts is dis.findlinestarts of its code)
+    p = getattr(i, "positions", None)
+    if p is not None:
+        return p.lineno
+    k = bisect.bisect_right(starts, (i.offset, sys.maxsize)) - 1
+    return starts[k][1] if k >= 0 else None
+
+
+def smells(co: types.CodeType, /, *, nested: bool = True) -> typing.Iterator[Smell]:
+    # global loads, and attribute loads off names the loop doesn't change,
+    # inside loops; each counted once, for its innermost loop. Exception
+    # handlers are left out
+    for c in code_objects(co) if nested else (co,):
+        if _back.isdisjoint(c.co_code[::2]):
+            continue
+        g = cfg(c)
+        starts = list(dis.findlinestarts(c))
+        inner: dict[int, int] = {}
+        for h, body in sorted(g.loops.items(), key=lambda i: -len(i[1])):
+            inner.update(dict.fromkeys(body, h))
+        for h, body in g.loops.items():
+            ins = [i for s in sorted(body) for i in g.blocks[s].instrs]
+            stored = {n for i in ins if i.opname in _stores for n in _stored(i)}
+            attrs = {i.argval for i in ins if i.opname in ("STORE_ATTR", "DELETE_ATTR")}
+            found: dict[tuple[str, str], list[dis.Instruction]] = {}
+            for s in sorted(body):
+                if inner[s] != h or g.blocks[s].exc:
+                    continue
+                prev = None
+                for i in g.blocks[s].instrs:
+                    if i.opname in ("LOAD_GLOBAL", "LOAD_NAME"):
+                        found.setdefault(("global", i.argval), []).append(i)
+                    elif i.opname in ("LOAD_ATTR", "LOAD_METHOD") and prev is not None and prev.opname in _bases:
+                        b = _base(prev)
+                        if b not in stored and i.argval not in attrs:
+                            found.setdefault(("attribute", f"{b}.{i.argval}"), []).append(i)
+                    prev = i
+            for (kind, name), xs in found.items():
+                yield Smell(
+                    g.name,
+                    _line(xs[0], starts),
+                    xs[0].offset,
+                    kind,
+                    name,
+                    len(xs),
+                    _line(g.blocks[h].instrs[0], starts),
+                )
+
+
+_enc = json.JSONEncoder(separators=(",", ":")).encode
+
+
+def _null(x: int | None) -> str:
+    return "null" if x is None else str(x)
+
+
+def to_json(r: Record, file: str | None = None) -> str:
+    # like json.dumps of r._asdict() (and the file first), without the
+    # generic encoder for the ints and names
+    return (
+        ("{" if file is None else f'{{"file":{_enc(file)},')
+        + f'"code":{_enc(r.code)},"offset":{r.offset},"line":{_null(r.line)},'
+        f'"opname":"{r.opname}","arg":{_null(r.arg)},"argrepr":{_enc(r.argrepr)},'
+        f'"purpose":{_enc(r.purpose)},"target":{_null(r.target)},'
+        f'"jump_target":{"true" if r.jump_target else "false"}}}'
+    )
+
+
+def _compile_file(path: str) -> tuple[types.CodeType, int]:
+    with open(path, "rb") as fi:
+        src = fi.read()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # SyntaxWarnings aren't ours to show
+        return compile(src, path, "exec"), len(src)
+
+
+def explain_file(path: str) -> tuple[str, str | Exception, int]:
+    # the records of a file as JSON lines, failures as the exception
+    try:
+        co, size = _compile_file(path)
+        out = [to_json(r, path) for r in explain(co)]
+        out.append("")
+        return path, "\n".join(out), size
+    except Exception as e:
+        return path, e, 0
+
+
+def smell_file(path: str) -> tuple[str, str | Exception, int]:
+    # like explain_file, with a line per smell instead
+    try:
+        co, size = _compile_file(path)
+        out = [
+            f"{path}:{i.line}: {i.kind} {i.name}"
+            f"{f' ({i.count} places)' if i.count > 1 else ''} in the loop at {i.loop} ({i.code})"
+            for i in smells(co)
+        ]
+        out.append("")
+        return path, "\n".join(out) if len(out) > 1 else "", size
+    except Exception as e:
+        return path, e, 0
+
+
+def explain_files(
+    paths: typing.Iterable[str],
+    /,
+    *,
+    jobs: int | None = None,
+    each: typing.Callable[[str], tuple[str, str | Exception, int]] = explain_file,
+) -> typing.Iterator[tuple[str, str | Exception, int]]:
+    # explain_file (or smell_file) over many files, in input order
+    return asttransfer.map_files(each, paths, jobs=jobs)
 
 
 def explain_ast(code: str):
     co = ast.parse(code, "exec")
 
 
-with open(__file__, "r") as fi:
-    explain_bytecode(fi.read())
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="explain python bytecode")
+    ap.add_argument(
+        "paths",
+        nargs="*",
+        help=".py files or dirs, written out as JSON lines (with --profile, the script's args, after --)",
+    )
+    ap.add_argument("-j", "--jobs", type=int, default=None)
+    ap.add_argument("--profile", metavar="SCRIPT", help="run a script, count the instructions it runs")
+    ap.add_argument("--top", type=int, default=5, help="code objects to list with --profile")
+    ap.add_argument("--smells", action="store_true", help="list slow things done in loops instead")
+    args = ap.parse_args()
+    if args.profile is not None:
+        import runpy
+
+        sys.argv = [args.profile, *args.paths]
+        sys.path[0] = os.path.dirname(os.path.abspath(args.profile))
+        p = Profile()
+        try:
+            with p:
+                runpy.run_path(args.profile, run_name="__main__")
+        except SystemExit:
+            pass
+        ops_run = p.by_opcode()
+        total = sum(ops_run.values()) or 1
+        print(f"-- {total} instructions run")
+        for op, n in ops_run.most_common(20):
+            print(f"{n:>12} {n / total:6.1%} {op}")
+        for co in list(p.by_code())[: args.top]:
+            explain_bytecode(co, {co: p.counts[co]})
+        sys.exit()
+    if not args.paths:
+        with open(__file__, "r") as fi:
+            explain_bytecode(fi.read())
+        sys.exit()
+    each = smell_file if args.smells else explain_file
+    files = asttransfer.find_files(args.paths)
+    asttransfer.write_results(explain_files(files, jobs=args.jobs, each=each), sys.stdout.write)
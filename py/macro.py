@@ -10,12 +10,17 @@
 #
 # -- mymac.py --
 # print(mac_stuff())
+#
+# or, after macro.install(), a mymac.mpy on sys.path imports as "import mymac",
+# with the expanded code cached in __pycache__
 # TODO: stabilization
 
 import ast
 from os import path
 import typing
 import tokenize, io
+import bisect, hashlib, marshal, os, re, sys, tempfile, types
+import importlib.abc, importlib.util
 
 macros = {"expr": {}, "stmt": {}, "tok": {}}
 
@@ -24,73 +29,264 @@ def macro(arg: str, type: typing.Literal["stmt"]
                         | typing.Literal["tok"] = "expr"):
     return lambda fn: macros[type].update({"mac_" + arg: fn})
 
+# a token macro call that was expanded, spanning start to end in the source
+class Expansion(typing.NamedTuple):
+    start: tuple[int, int]
+    end: tuple[int, int]
+    tokens: list
+
+def _sites(toks: typing.Iterable[tokenize.TokenInfo]) -> typing.Iterator[tokenize.TokenInfo | Expansion]:
+    # one pass; calls inside a macro's arguments get expanded first, and
+    # their tokens go to the enclosing call (a stack of them, not recursion)
+    tab = macros["tok"]
+    stack: list[list] = [] # [fn, open parens, args, start]
+    toks = iter(toks)
+    cur = next(toks, None)
+    while cur is not None:
+        nxt = next(toks, None)
+        if cur.type == tokenize.NAME and cur.string in tab \
+                and nxt is not None and nxt.type == tokenize.OP and nxt.string == "(":
+            stack.append([tab[cur.string], 0, [], cur.start])
+            cur = next(toks, None)
+            continue
+        if not stack:
+            yield cur
+        elif cur.type == tokenize.OP and cur.string == ")" and not stack[-1][1]:
+            fn, _, args, start = stack.pop()
+            ret = list(fn(*args) or ())
+            if stack:
+                stack[-1][2] += ret
+            else:
+                yield Expansion(start, cur.end, ret)
+        else:
+            if cur.type == tokenize.OP and cur.string == "(":
+                stack[-1][1] += 1
+            elif cur.type == tokenize.OP and cur.string == ")":
+                stack[-1][1] -= 1
+            stack[-1][2].append(cur)
+        cur = nxt
+    if stack:
+        raise SyntaxError("unclosed token macro call")
+
+def expand(toks: typing.Iterable[tokenize.TokenInfo]) -> typing.Iterator[tokenize.TokenInfo]:
+    # the token stage on its own, lazily: tokens in, tokens out, with
+    # whatever the macros returned in place of their calls
+    for i in _sites(toks):
+        if isinstance(i, Expansion):
+            yield from i.tokens
+        else:
+            yield i
+
+def expand_tokens(code: str) -> str:
+    # the source between calls is copied as is, only the macros' tokens go
+    # through untokenize (as (type, string) pairs, their positions don't
+    # fit the file)
+    rd = io.StringIO(code).readline
+    starts = [0]
+    def readline() -> str:
+        ln = rd()
+        starts.append(starts[-1] + len(ln))
+        return ln
+    out = []
+    last = 0
+    for i in _sites(tokenize.generate_tokens(readline)):
+        if isinstance(i, Expansion):
+            out.append(code[last:starts[i.start[0] - 1] + i.start[1]])
+            out.append(tokenize.untokenize([(t[0], t[1]) for t in i.tokens]))
+            last = starts[i.end[0] - 1] + i.end[1]
+    out.append(code[last:])
+    return "".join(out)
+
+# names that might be macros, to skip the work for files without any
+_mac_name = re.compile(r"\bmac_\w+")
+
+def compile_with_macros(code: str, filename: str) -> types.CodeType:
+    # each stage only runs when the source names a macro it handles
+    names = set(_mac_name.findall(code)) if "mac_" in code else set()
+    if not names.isdisjoint(macros["tok"]):
+        code = expand_tokens(code)
+        names = set(_mac_name.findall(code))
+    if names.isdisjoint(macros["expr"]) and names.isdisjoint(macros["stmt"]):
+        return compile(code, filename, "exec")
+    nodes = ast.parse(code, filename, "exec")
+    nodes = MacroExecutor(site_lines(code)).visit(nodes)
+    ast.fix_missing_locations(nodes)
+    return compile(nodes, filename, "exec")
+
+# the lines naming expression or statement macros (in the numbering ast
+# uses), for MacroExecutor to skip the rest of the tree
+def site_lines(code: str) -> list[int] | None:
+    if "\r" in code and re.search(r"\r(?!\n)", code):
+        return None # lone \r breaks lines too, counting "\n" won't do
+    ret = []
+    ln, pos = 1, 0
+    for m in _mac_name.finditer(code):
+        if m.group() in macros["expr"] or m.group() in macros["stmt"]:
+            ln += code.count("\n", pos, m.start())
+            pos = m.start()
+            if not ret or ret[-1] != ln:
+                ret.append(ln)
+    return ret
+
 def import_with_macros(file: str):
     with open(file, "r") as strm:
         code = strm.read()
-    tok = tokenize.tokenize(io.BytesIO(code.encode("utf8")).readline)
-    tok = list(tok)[::-1]
-    nl = []
-    while tok:
-        cur = tok.pop()
-        if cur.type == tokenize.NAME and cur.string in macros["tok"]:
-            ch = tok.pop()
-            if ch.type == tokenize.OP and ch.string == "(":
-                qs = 1
-                ls = []
-                while qs:
-                    c = tok.pop()
-                    if c.type == tokenize.OP and c.string == ")":
-                        qs -= 1
-                    if c.type == tokenize.OP and c.string == "(":
-                        qs += 1
-                    if qs:
-                        ls.append(c)
-                ret: list[tokenize.TokenInfo] = list(macros["tok"][cur.string](*ls))
-                if ret:
-                    nl += [*ret]
+    exec(compile_with_macros(code, path.realpath(file)))
+
+# the cached code is only good for the same macros, so their code goes into
+# the name of the .pyc (the source's mtime and size are in its header, as
+# usual). Macros without a __code__ get a fresh fingerprint every time.
+def fingerprint() -> str:
+    h = hashlib.sha256()
+    for tp in sorted(macros):
+        for name, fn in sorted(macros[tp].items()):
+            h.update(f"{tp}:{name}:".encode())
+            co = getattr(fn, "__code__", None)
+            h.update(marshal.dumps(co) if co is not None else repr(fn).encode())
+    return h.hexdigest()[:16]
+
+def cache_from_source(file: str) -> str:
+    d, name = path.split(file)
+    name = path.splitext(name)[0]
+    tag = sys.implementation.cache_tag
+    return path.join(d, "__pycache__", f"{name}.{tag}.macro-{fingerprint()}.pyc")
+
+class MacroLoader(importlib.abc.Loader):
+    def __init__(self, fullname: str, file: str):
+        self.name = fullname
+        self.path = file
+    def get_filename(self, fullname: str) -> str:
+        return self.path
+    def get_source(self, fullname: str) -> str:
+        with open(self.path, "r") as strm:
+            return strm.read()
+    def get_code(self, fullname: str) -> types.CodeType:
+        st = os.stat(self.path)
+        head = importlib.util.MAGIC_NUMBER + (0).to_bytes(4, "little")
+        head += (int(st.st_mtime) & 0xFFFFFFFF).to_bytes(4, "little")
+        head += (st.st_size & 0xFFFFFFFF).to_bytes(4, "little")
+        pyc = cache_from_source(self.path)
+        try:
+            with open(pyc, "rb") as strm:
+                data = strm.read()
+            if data[:16] == head:
+                return marshal.loads(data[16:])
+        except (OSError, EOFError, ValueError, TypeError):
+            pass
+        co = compile_with_macros(self.get_source(fullname), self.path)
+        if not sys.dont_write_bytecode:
+            try:
+                os.makedirs(path.dirname(pyc), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=path.dirname(pyc))
+                with os.fdopen(fd, "wb") as strm:
+                    strm.write(head + marshal.dumps(co))
+                os.replace(tmp, pyc)
+            except OSError:
+                pass
+        return co
+    def create_module(self, spec):
+        return None
+    def exec_module(self, module: types.ModuleType):
+        exec(self.get_code(module.__name__), module.__dict__)
+
+# finds modules in .mpy files, after all the usual finders came up empty
+class MacroFinder(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname: str, paths=None, target=None):
+        name = fullname.rpartition(".")[2]
+        for d in paths if paths is not None else sys.path:
+            file = path.join(d or ".", name + ".mpy")
+            if path.isfile(file):
+                return importlib.util.spec_from_file_location(
+                    fullname, file, loader=MacroLoader(fullname, file))
+        return None
+
+def install():
+    if not any(isinstance(i, MacroFinder) for i in sys.meta_path):
+        sys.meta_path.append(MacroFinder())
+
+def uninstall():
+    sys.meta_path[:] = [i for i in sys.meta_path if not isinstance(i, MacroFinder)]
+
+# expands macro calls where they sit: one walk collects the candidate sites
+# (calls to a registered mac_ name, with the list or node holding them), then
+# a worklist expands them innermost first. What a macro returns is scanned for
+# new sites on its own, not the whole tree again. Given the site lines (see
+# site_lines), the first walk skips nodes spanning none of them.
+class MacroExecutor:
+    # how many times macros may expand into further macros
+    limit = 100
+    def __init__(self, lines: typing.Sequence[int] | None = None):
+        self.lines = lines
+    def visit(self, node: ast.AST) -> typing.Any:
+        top = [node]
+        work: list = []
+        self._scan(top, 0, node, 0, work, self.lines)
+        while work:
+            c, k, n, depth = work.pop()
+            if depth > self.limit:
+                raise RecursionError(f"macros still expanding after {self.limit} rounds")
+            # the arguments are expanded already, only what's new is scanned
+            call = n.value if isinstance(n, ast.Expr) else n
+            old = {id(i) for i in call.args}
+            old.update(id(i.value) for i in call.keywords)
+            if isinstance(n, ast.Expr):
+                ret = self._call(macros["stmt"], call)
+                ret = [] if ret is None else ret if isinstance(ret, list) else [ret]
+                c[k:k + 1] = ret
+                for i in range(len(ret)):
+                    self._scan(c, k + i, ret[i], depth + 1, work, skip=old)
             else:
-                nl.append(cur)
-                nl.append(ch)
-        else:
-            nl.append(cur)
-    ncode = tokenize.untokenize(nl)
-    nodes = ast.parse(ncode, "exec")
-    nodes = MacroExecutor().visit(nodes)
-    ast.fix_missing_locations(nodes)
-    exec(compile(nodes, path.realpath(file), "exec"))
-
-class MacroExecutor(ast.NodeTransformer):
-    def visit_Call(self, arg: ast.Call) -> ast.expr:
-        self.generic_visit(arg)
-        match arg:
-            case ast.Call(func = ast.Name(id = name)):
-                if name not in macros["expr"] or name in macros["stmt"]:
-                    return arg
-                func = macros["expr"][name]
-                kws = {}
-                for i in arg.keywords:
-                    if i.arg:
-                        kws[i.arg] = i.value
-                    else:
-                        kws["star"] = i.value
-                return func(*arg.args, **kws)
-            case o:
-                return o
-    def visit_Expr(self, node: ast.Expr) -> ast.stmt:
-        self.generic_visit(node)
-        match node:
-            case ast.Expr(value = ast.Call(func = ast.Name(id = name))):
-                val = node.value
-                assert isinstance(val, ast.Call) # calms pyright
-                if name not in macros["stmt"]:
-                    return node
-                fn = macros["stmt"][name]
-                kws = {}
-                for i in val.keywords:
-                    if i.arg:
-                        kws[i.arg] = i.value
-                    else:
-                        kws["star"] = i.value
-                return fn(*val.args, **kws)
-            case o:
-                return o
+                ret = self._call(macros["expr"], call)
+                if type(c) is list:
+                    c[k] = ret
+                else:
+                    setattr(c, k, ret)
+                self._scan(c, k, ret, depth + 1, work, skip=old)
+        return top[0] if len(top) == 1 else top or None
+    @staticmethod
+    def _call(tab: dict, call: ast.Call) -> typing.Any:
+        kws = {}
+        for i in call.keywords:
+            if i.arg:
+                kws[i.arg] = i.value
+            else:
+                kws["star"] = i.value
+        return tab[call.func.id](*call.args, **kws)
+    @staticmethod
+    def _scan(c: typing.Any, k: int | str, node: typing.Any, depth: int, work: list,
+              lines: typing.Sequence[int] | None = None, skip: set[int] | None = None):
+        # adds the sites under node (held at c[k] or c.k) to work, in source
+        # order, so popping them expands arguments before their calls
+        ex, st = macros["expr"], macros["stmt"]
+        stack = [(c, k, node)]
+        while stack:
+            c, k, n = stack.pop()
+            if skip is not None and id(n) in skip:
+                continue
+            if lines is not None and getattr(n, "end_lineno", None) is not None:
+                lo = n.lineno
+                for d in getattr(n, "decorator_list", ()):
+                    lo = min(lo, getattr(d, "lineno", lo))
+                i = bisect.bisect_left(lines, lo)
+                if i == len(lines) or lines[i] > n.end_lineno:
+                    continue
+            if isinstance(n, ast.Call):
+                f = n.func
+                if isinstance(f, ast.Name) and f.id in ex and f.id not in st:
+                    work.append((c, k, n, depth))
+            elif isinstance(n, ast.Expr):
+                v = n.value
+                if isinstance(v, ast.Call) and isinstance(v.func, ast.Name) and v.func.id in st:
+                    if type(c) is list:
+                        work.append((c, k, n, depth))
+            elif not isinstance(n, ast.AST):
+                continue
+            kids = []
+            for f in n._fields:
+                v = getattr(n, f, None)
+                if type(v) is list:
+                    kids += [(v, i, x) for i, x in enumerate(v) if isinstance(x, ast.AST)]
+                elif isinstance(v, ast.AST):
+                    kids.append((n, f, v))
+            kids.reverse()
+            stack += kids
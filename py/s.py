@@ -4,111 +4,563 @@
 # 
 # import s
 # print(s.py_to_s(("a", "b", "c")))
+# with open("log.s") as fi:
+#     for form in s.iter_forms(fi):
+#         print(form)
+# print(s.LazyForm.open("big.s")[2][1234].load())
 #
 # TODO: locate and squish bugs
 
+import array, bisect, codecs, contextlib, functools, gc, mmap, re, struct, sys
+import typing
+
 se_type = str | tuple["se_type", ...]
 
-cm = {"x": 2, "u": 4, "U": 8}
+_tok = re.compile(
+    r"""[()]|"[^"\\]*(?:\\[\s\S]?[^"\\]*)*"?|'[^'\\]*(?:\\[\s\S]?[^'\\]*)*'?|;[^\n]*|[^\s();]+"""
+)
+_esc = re.compile(r"\\(?:x([\s\S]{2})|u([\s\S]{4})|U([\s\S]{8})|([\s\S]))")
 
 
-def s_to_py(inp: str) -> tuple[se_type, ...]:
-    stack = []
-    q = list(inp)[::-1]
-    quot = ""
-    while q:
-        cur = q.pop()
-        if cur.isspace():
-            continue
-        if cur == ";":
-            while q and q[-1] != "\n":
-                q.pop()
-            continue
-        if cur == "(":
-            stack.append([])
-            continue
-        if cur == ")":
-            if len(stack) == 1:
-                return tuple(stack.pop())
-            stack[-2].append(tuple(stack.pop()))
-            continue
-        if cur in "'\"":
-            cs = ""
-            quot = cur
-            while q:
-                cur = q.pop()
-                if cur == quot:
-                    break
-                if cur == "\\":
-                    es = q.pop()
-                    if es == "n":
-                        cs += "\n"
-                    elif es in cm:
-                        c = ""
-                        for _ in range(cm[es]):
-                            c += q.pop()
-                        c = int(c, base=16)
-                        cs += chr(c)
-                    else:
-                        cs += es
+def _unescape_one(m: re.Match) -> str:
+    h = m.group(1) or m.group(2) or m.group(3)
+    if h:
+        return chr(int(h, base=16))
+    c = m.group(4)
+    return "\n" if c == "n" else c
+
+
+def _unescape(inp: str) -> str:
+    if "\\" not in inp:
+        return inp
+    return _esc.sub(_unescape_one, inp)
+
+
+class _Reader:
+    # parser state that survives between chunks of input
+    def __init__(self):
+        self.stack = []
+        self.cur = None
+
+    def feed(self, toks: list[str]) -> typing.Iterator[tuple[se_type, ...]]:
+        stack = self.stack
+        cur = self.cur
+        for t in toks:
+            c = t[0]
+            if c == "(":
+                stack.append(cur)
+                cur = []
+            elif c == ")":
+                if cur is None:
+                    raise Exception("Brackets don't close correctly")
+                t = tuple(cur)
+                cur = stack.pop()
+                if cur is None:
+                    self.cur = cur
+                    yield t
+                else:
+                    cur.append(t)
+            elif c == '"' or c == "'":
+                cur.append(_unescape(t[1:-1]))
+            elif c != ";":
+                cur.append(t)
+        self.cur = cur
+
+
+class _SharingReader(_Reader):
+    # interns every atom and, with share, also hash-conses tuples. Children
+    # are canonical by the time their parent closes, so the ids of the
+    # children identify a subtree (the memo keeps them alive, so ids don't
+    # get reused); that avoids hashing whole subtrees over and over.
+    def __init__(self, share: bool):
+        super().__init__()
+        self.memo: dict[tuple[int, ...], tuple[se_type, ...]] | None = (
+            {} if share else None
+        )
+
+    def feed(self, toks: list[str]) -> typing.Iterator[tuple[se_type, ...]]:
+        stack = self.stack
+        cur = self.cur
+        memo = self.memo
+        intern = sys.intern
+        for t in toks:
+            c = t[0]
+            if c == "(":
+                stack.append(cur)
+                cur = []
+            elif c == ")":
+                if cur is None:
+                    raise Exception("Brackets don't close correctly")
+                t = tuple(cur)
+                if memo is not None:
+                    t = memo.setdefault(tuple(map(id, t)), t)
+                cur = stack.pop()
+                if cur is None:
+                    self.cur = cur
+                    yield t
                 else:
-                    cs += cur
-            stack[-1].append(cs)
-            continue
-        cs = cur
-        while not q[-1].isspace() and q[-1] not in ["(", ")", ";"]:
-            cs += q.pop()
-        stack[-1].append(cs)
+                    cur.append(t)
+            elif c == '"' or c == "'":
+                cur.append(intern(_unescape(t[1:-1])))
+            elif c != ";":
+                cur.append(intern(t))
+        self.cur = cur
+
+
+def _reader(intern: bool, share: bool) -> _Reader:
+    if intern or share:
+        return _SharingReader(share)
+    return _Reader()
+
+
+@contextlib.contextmanager
+def _nogc():
+    # building millions of tuples keeps triggering the cycle collector for
+    # nothing, since none of them can be part of a cycle
+    if not gc.isenabled():
+        yield
+        return
+    gc.disable()
+    try:
+        yield
+    finally:
+        gc.enable()
+
+
+def s_to_py(
+    inp: str, /, *, intern: bool = False, share: bool = False
+) -> tuple[se_type, ...]:
+    # whitespace never matches, so findall skips it at C speed and the
+    # reader only ever looks at the first character of each token
+    with _nogc():
+        for i in _reader(intern, share).feed(_tok.findall(inp)):
+            return i
     raise Exception("Brackets don't close correctly")
 
 
+# what finishes a token held back at the end of a chunk: atoms end at a
+# delimiter, comments at a newline and strings at an unescaped quote
+_atom_end = re.compile(r"[\s();]")
+_str_body = {q: re.compile(rf"[^{q}\\]*(?:\\[\s\S][^{q}\\]*)*") for q in "\"'"}
+
+
+def _held_ends(c: str, chunk: str, esc: bool) -> tuple[bool, bool]:
+    # whether chunk finishes a held-back token starting with c, and whether
+    # a held-back string is left in the middle of an escape
+    if c == ";":
+        return "\n" in chunk, False
+    if c == '"' or c == "'":
+        if not chunk:
+            return False, esc
+        e = _str_body[c].match(chunk, 1 if esc else 0).end()
+        if e == len(chunk):
+            return False, False
+        return chunk[e] == c, chunk[e] != c
+    return _atom_end.search(chunk) is not None, False
+
+
+def iter_forms(
+    inp: typing.IO,
+    chunk_size: int = 1 << 16,
+    *,
+    intern: bool = False,
+    share: bool = False,
+) -> typing.Iterator[tuple[se_type, ...]]:
+    # with share, identical subtrees are shared across the whole file
+    rd = _reader(intern, share)
+    dec = None
+    held = []  # the unfinished token at the end of the input so far, in parts
+    esc = False
+    while True:
+        chunk = inp.read(chunk_size)
+        eof = not chunk
+        if isinstance(chunk, bytes):
+            if dec is None:
+                dec = codecs.getincrementaldecoder("utf-8")()
+            chunk = dec.decode(chunk, eof)
+        if held and not eof:
+            # only rescan once the held-back token can have ended, so a long
+            # atom or string costs one scan instead of one per chunk
+            done, esc = _held_ends(held[0][0], chunk, esc)
+            if not done:
+                held.append(chunk)
+                continue
+        held.append(chunk)
+        buf = "".join(held)
+        held = []
+        toks = _tok.findall(buf)
+        # the token touching the end of the buffer may continue in the next
+        # chunk (atoms, strings, comments, escapes), so hold it back
+        if not eof and toks and toks[-1] not in "()" and buf.endswith(toks[-1]):
+            last = toks[-1]
+            c = last[0]
+            if c == '"' or c == "'":
+                e = _str_body[c].match(last, 1).end()
+                if e < len(last) and last[e] == c:
+                    c = None  # already closed, nothing can extend it
+                else:
+                    esc = e < len(last)
+            if c is not None:
+                held.append(toks.pop())
+        yield from rd.feed(toks)
+        if eof:
+            break
+    if rd.cur is not None:
+        raise Exception("Brackets don't close correctly")
+
+
+# characters that force an atom into quotes, and those that need escaping
+# inside the quotes (everything outside printable ascii, plus " \ and \n)
+_quoted = re.compile(r"[^!#-&*-:<-~]")
+_escaped = re.compile(r'[^ !#-\[\]-~]')
+
+
+def _escape_chr(m: re.Match) -> str:
+    i = ord(m.group())
+    if i == 0x0A:
+        return "\\n"
+    if i == 0x22 or i == 0x5C:
+        return "\\" + chr(i)
+    if i < 0x100:
+        return f"\\x{i:02x}"
+    if i < 0x10000:
+        return f"\\u{i:04x}"
+    return f"\\U{i:08x}"
+
+
 def _escape_str(inp: str):
-    c = '"'
-    for i in inp:
-        if i == "\n":
-            c += "\\n"
-        elif ord(i) < ord(" ") or ord(i) > ord("~"):
-            if ord(i) < 0x100:
-                c += f"\\x{ord(i):02x}"
-            elif ord(i) < 0x10000:
-                c += f"\\u{ord(i):04x}"
+    return '"' + _escaped.sub(_escape_chr, inp) + '"'
+
+
+# identifiers and constructor names repeat a lot, so remember them
+@functools.lru_cache(maxsize=1 << 14)
+def _atom(inp: str) -> str:
+    if inp and _quoted.search(inp) is None:
+        return inp
+    return _escape_str(inp)
+
+
+def _emit(inp: se_type, w: typing.Callable[[str], typing.Any], indent: str | None):
+    # writes the s-expression piece by piece through w, keeping an explicit
+    # stack of open tuples instead of recursing
+    if indent is None:
+        w("(")
+        stack = [iter(inp)]
+        first = [True]
+        while stack:
+            for i in stack[-1]:
+                if first[-1]:
+                    first[-1] = False
+                else:
+                    w(" ")
+                if isinstance(i, tuple):
+                    w("(")
+                    stack.append(iter(i))
+                    first.append(True)
+                    break
+                assert isinstance(i, str)
+                w(_atom(i))
             else:
-                c += f"\\U{ord(i):08x}"
-        elif i == '"':
-            c += '\\"'
+                stack.pop()
+                first.pop()
+                w(")")
+        return
+    # a tuple with a single child is written inline around it, otherwise every
+    # child goes on its own line, one indent deeper than the closing bracket
+    pre = ["\n"]
+    stack = []
+
+    def push(node, lvl: int):
+        if len(node) == 0:
+            w("()")
+            return
+        w("(")
+        if len(node) == 1:
+            stack.append((iter(node), lvl, False))
+            return
+        lvl += 1
+        while len(pre) <= lvl:
+            pre.append(pre[-1] + indent)
+        stack.append((iter(node), lvl, True))
+
+    push(inp if isinstance(inp, tuple) else tuple(inp), 0)
+    while stack:
+        it, lvl, multi = stack[-1]
+        for i in it:
+            if multi:
+                w(pre[lvl])
+            if isinstance(i, tuple):
+                n = len(stack)
+                push(i, lvl)
+                if len(stack) > n:
+                    break
+                continue
+            assert isinstance(i, str)
+            w(_atom(i))
         else:
-            c += i
-    return c + '"'
+            stack.pop()
+            w(pre[lvl - 1] + ")" if multi else ")")
 
 
 def py_to_s(inp: se_type, /, *, indent: int | str | None = None) -> str:
+    if isinstance(indent, int):
+        indent = " " * indent
     ss = []
+    _emit(inp, ss.append, indent)
+    return "".join(ss)
+
+
+def dump(inp: se_type, fp: typing.IO[str], /, *, indent: int | str | None = None):
     if isinstance(indent, int):
         indent = " " * indent
-    for i in inp:
-        if isinstance(i, tuple):
-            ss.append(py_to_s(i, indent=indent))
-            continue
-        assert isinstance(i, str)
-        c = False
-        for j in i:
-            if j.isspace() or j in "()\"'":
-                c = True
-            if ord(j) < ord(" ") or ord(j) > ord("~"):
-                c = True
-        if not c:
-            ss.append(i)
-            continue
-        ss.append(_escape_str(i))
-    if indent is None:
-        return "(" + " ".join(ss) + ")"
-    else:
-        if len(ss) == 0:
-            return "()"
-        if len(ss) == 1:
-            return f"({ss[0]})"
-        ret = "("
-        for i in ss:
-            for j in i.split("\n"):
-                ret += f"\n{indent}{j}"
-        return ret + "\n)"
+    ss = []
+
+    def w(x: str):
+        ss.append(x)
+        if len(ss) >= 4096:
+            fp.write("".join(ss))
+            ss.clear()
+
+    _emit(inp, w, indent)
+    fp.write("".join(ss))
+
+
+# compact binary form: a header, a table of distinct atoms (char offsets into
+# one utf-8 blob), the atoms of the tree in order as indices into that table,
+# and the nesting as codes (k << 2) | op, where k is the number of atoms
+# between the previous code and this one, and op is 0 for an opening
+# bracket, 1 for a closing one and 2 for a tuple of atoms only, whose length
+# follows as the next code. Both code arrays use the narrowest of 1, 2 or 4
+# bytes that fits. Everything is little-endian.
+# Keeping the atoms apart lets from_bytes map and slice them in bulk, so it
+# only loops once per bracket (or once per all-atom tuple, most of an ast).
+_bmagic = b"SEB\x01"
+_bhead = struct.Struct("<4sBBIIII")
+_bwidth = {1: "B", 2: "H", 4: "I"}
+
+
+def _bnarrow(codes: array.array) -> tuple[int, array.array]:
+    m = max(codes, default=0)
+    width = 1 if m < 0x100 else 2 if m < 0x10000 else 4
+    codes = array.array(_bwidth[width], codes)
+    if sys.byteorder == "big":
+        codes.byteswap()
+    return width, codes
+
+
+def to_bytes(inp: se_type) -> bytes:
+    atoms: dict[str, int] = {}
+    acodes = array.array("I")
+    shape = array.array("I", [0])
+    k = 0
+    stack = [iter(inp)]
+    while stack:
+        for i in stack[-1]:
+            if isinstance(i, tuple):
+                for j in i:
+                    if isinstance(j, tuple):
+                        shape.append(k << 2)
+                        k = 0
+                        stack.append(iter(i))
+                        break
+                else:
+                    shape.append(k << 2 | 2)
+                    shape.append(len(i))
+                    k = 0
+                    for j in i:
+                        c = atoms.get(j)
+                        if c is None:
+                            c = atoms[j] = len(atoms)
+                        acodes.append(c)
+                    continue
+                break
+            c = atoms.get(i)
+            if c is None:
+                c = atoms[i] = len(atoms)
+            acodes.append(c)
+            k += 1
+        else:
+            stack.pop()
+            shape.append(k << 2 | 1)
+            k = 0
+    offs = array.array("I", [0])
+    n = 0
+    for i in atoms:
+        n += len(i)
+        offs.append(n)
+    if sys.byteorder == "big":
+        offs.byteswap()
+    blob = "".join(atoms).encode("utf-8", "surrogatepass")
+    aw, acodes = _bnarrow(acodes)
+    sw, shape = _bnarrow(shape)
+    head = _bhead.pack(_bmagic, aw, sw, len(atoms), len(blob), len(acodes), len(shape))
+    return b"".join((head, offs.tobytes(), blob, acodes.tobytes(), shape.tobytes()))
+
+
+def _bview(mv: memoryview, fmt: str) -> typing.Sequence[int]:
+    if sys.byteorder == "little":
+        return mv.cast(fmt)
+    ret = array.array(fmt, mv)
+    ret.byteswap()
+    return ret
+
+
+def from_bytes(inp: bytes | bytearray | memoryview | mmap.mmap) -> tuple[se_type, ...]:
+    # anything that isn't a whole form from to_bytes is a ValueError
+    mv = memoryview(inp).cast("B")
+    if len(mv) < _bhead.size:
+        raise ValueError("Not a binary s-expression")
+    magic, aw, sw, n, nb, na, ns = _bhead.unpack_from(mv)
+    if magic != _bmagic or aw not in _bwidth or sw not in _bwidth:
+        raise ValueError("Not a binary s-expression")
+    p = _bhead.size
+    if len(mv) < p + 4 * (n + 1) + nb + aw * na + sw * ns:
+        raise ValueError("Truncated binary s-expression")
+    offs = _bview(mv[p : p + 4 * (n + 1)], "I")
+    p += 4 * (n + 1)
+    text = str(mv[p : p + nb], "utf-8", "surrogatepass")
+    p += nb
+    acodes = _bview(mv[p : p + aw * na], _bwidth[aw])
+    p += aw * na
+    shape = _bview(mv[p : p + sw * ns], _bwidth[sw])
+    table = [text[a:b] for a, b in zip(offs, offs[1:])]
+    try:
+        flat = list(map(table.__getitem__, acodes))
+    except IndexError:
+        raise ValueError("Corrupt binary s-expression") from None
+    p = 0
+    stack = []
+    cur = None
+    shape = iter(shape)
+    with _nogc():
+        try:
+            for e in shape:
+                k = e >> 2
+                if k:
+                    cur += flat[p : p + k]
+                    p += k
+                e &= 3
+                if e == 2:
+                    k = next(shape)
+                    cur.append(tuple(flat[p : p + k]))
+                    p += k
+                    continue
+                if e == 0:
+                    stack.append(cur)
+                    cur = []
+                    continue
+                t = tuple(cur)
+                cur = stack.pop()
+                if cur is None:
+                    return t
+                cur.append(t)
+        except (TypeError, AttributeError, IndexError, StopIteration):
+            raise ValueError("Corrupt binary s-expression") from None
+    raise ValueError("Truncated binary s-expression")
+
+
+# lazy, random-access view over a (memory-mapped) file. One pass records where
+# every bracket pair opens and closes; after that a form only scans its own
+# children when first accessed, skipping nested forms by their recorded end.
+# Works on utf-8 bytes, so only ascii whitespace separates tokens.
+_btok = re.compile(_tok.pattern.encode())
+# everything after the run of atoms is optional, so the pattern can't fail:
+# a run with no bracket after it matches up to the end in one go, instead of
+# backtracking through every way of splitting its atoms (and being rescanned
+# from each of its characters)
+_bstruct = re.compile(
+    rb"""(?:[^\s();'"][^\s();]*|\s+)*(?:([()])|"[^"\\]*(?:\\[\s\S]?[^"\\]*)*"?|'[^'\\]*(?:\\[\s\S]?[^'\\]*)*'?|;[^\n]*)?"""
+)
+
+
+class _Index:
+    def __init__(self, buf):
+        self.buf = buf
+        self.opens = array.array("q")
+        self.closes = array.array("q")
+        opens, closes = self.opens, self.closes
+        stack = []
+        for m in _bstruct.finditer(buf):
+            if m.lastindex is None:
+                continue
+            p = m.end() - 1
+            if buf[p] == 0x28:
+                stack.append(len(opens))
+                opens.append(p)
+                closes.append(-1)
+                continue
+            if not stack:
+                raise Exception("Brackets don't close correctly")
+            closes[stack.pop()] = p
+            if not stack:
+                break
+        if stack or not opens:
+            raise Exception("Brackets don't close correctly")
+
+    def close_of(self, p: int) -> int:
+        return self.closes[bisect.bisect_left(self.opens, p)]
+
+
+class LazyForm:
+    __slots__ = ("_idx", "_start", "_end", "_items")
+
+    def __init__(self, buf: bytes | bytearray | mmap.mmap, /):
+        self._idx = _Index(buf)
+        self._start = self._idx.opens[0]
+        self._end = self._idx.closes[0]
+        self._items = None
+
+    @classmethod
+    def open(cls, file: str) -> "LazyForm":
+        with open(file, "rb") as fi:
+            return cls(mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _child(self, start: int, end: int) -> "LazyForm":
+        ret = LazyForm.__new__(LazyForm)
+        ret._idx = self._idx
+        ret._start = start
+        ret._end = end
+        ret._items = None
+        return ret
+
+    def _load(self) -> list:
+        if self._items is not None:
+            return self._items
+        idx = self._idx
+        buf = idx.buf
+        items = []
+        p = self._start + 1
+        end = self._end
+        while True:
+            m = _btok.search(buf, p, end)
+            if m is None:
+                break
+            t = m.group()
+            c = t[0]
+            if c == 0x28:
+                e = idx.close_of(m.start())
+                items.append(self._child(m.start(), e))
+                p = e + 1
+                continue
+            p = m.end()
+            if c == 0x22 or c == 0x27:
+                items.append(_unescape(t[1:-1].decode("utf-8")))
+            elif c != 0x3B:
+                items.append(t.decode("utf-8"))
+        self._items = items
+        return items
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def __getitem__(self, i):
+        return self._load()[i]
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def load(self) -> tuple[se_type, ...]:
+        return s_to_py(str(self._idx.buf[self._start : self._end + 1], "utf-8"))
+
+    def __repr__(self) -> str:
+        return f"<LazyForm {self._start}..{self._end}>"